@@ -1,2 +1,6 @@
-from .azuread import AzureAd
-from .azurecontainer import AzureContainer
\ No newline at end of file
+from .azuread import AzureAd, get_graph_scope
+from .azureaddelta import AzureAdDelta
+from .azurecontainer import AzureContainer
+from .blobcache import BlobCache
+from .httpsession import create_session
+from .tokencache import CachedCredential
\ No newline at end of file
@@ -1,30 +1,101 @@
-from azure.identity import ClientSecretCredential
-import requests
+from .httpsession import create_session, RETRY_STATUS_CODES
+from metrics import registry
+from requests.exceptions import HTTPError
+from urllib.parse import quote, urlencode, urlsplit
 import logging
+import time
+
+
+def get_graph_scope(graph_url):
+    """
+    returns the token scope of the given graph api, e.g. https://graph.microsoft.us/.default for national clouds
+    :param graph_url: base url of the graph api
+    :return: scope
+    """
+
+    url = urlsplit(graph_url)
+    return f'{url.scheme}://{url.netloc}/.default'
+
 
 class AzureAd(object):
     """
         simple azure ad client to retrieve group and user information from azure ad
     """
 
-    def __init__(self, tenant_id, client_id, client_secret):
-        self.credentials = ClientSecretCredential(
-            tenant_id=tenant_id,
-            client_id=client_id,
-           client_secret=client_secret
-       )
+    # user fields required by the sync, only these are retrieved in transitive mode
+    MINIMAL_SELECT = [
+        'id',
+        'accountEnabled',
+        'userPrincipalName',
+    ]
 
-        self.graph_token = self.credentials.get_token('https://graph.microsoft.com/.default').token
+    def __init__(self, credentials, session=None, timeout=(10, 60), retries=5, backoff_factor=1,
+                 graph_url='https://graph.microsoft.com/v1.0'):
+        """
+        initialize the azure ad client
+        :param credentials: azure credential used to acquire graph tokens
+        :param session: pooled requests session, a new session is created if not given
+        :param timeout: (connect, read) timeout of the graph requests in seconds
+        :param retries: maximum number of retries for throttled or failed requests
+        :param backoff_factor: backoff factor for retries, see create_session
+        :param graph_url: base url of the graph api, e.g. for national clouds
+        """
+        self.credentials = credentials
+        self.graph_url = graph_url.rstrip('/')
+        # tokens are requested for the cloud of the graph api
+        self.graph_scope = get_graph_scope(self.graph_url)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.session = session or create_session(retries=retries, backoff_factor=backoff_factor)
 
+    @property
+    def graph_token(self):
+        """
+        returns a valid graph token, the credential takes care of caching and refreshing it
+        :return: access token string
+        """
+        return self.credentials.get_token(self.graph_scope).token
 
-    def get_group_members(self, group_id, additional_fields=[]):
+    def get_pages(self, url, params=None, headers=None):
         """
-        retrieve a list of all azure ad group members and return
-        a list of enabled azure users
-        :param group_id:
-        :return:
+        retrieve the given graph api url and follow all @odata.nextLink references.
+        each retrieved page is yielded as soon as it arrives
+
+        :param url: graph api url to retrieve
+        :param params: query parameters for the first request, the nextLink already contains them
+        :param headers: additional request headers
+        :return: generator of page dictionaries
         """
 
+        while url:
+            r = self.session.get(
+                url=url,
+                # authorize request with the given token
+                headers=dict(headers or {}, Authorization=f'Bearer {self.graph_token}'),
+                params=params,
+                timeout=self.timeout,
+            )
+            r.raise_for_status()
+            page = r.json()
+            registry.inc('http_response_bytes_total', len(r.content), client='graph')
+            yield page
+
+            # the next link contains all query parameters of the initial request
+            url = page.get('@odata.nextLink')
+            params = None
+
+    def get_member_select(self, additional_fields=[], minimal=False):
+        """
+        returns the list of user fields retrieved for group members
+        :param additional_fields: additional user fields to retrieve
+        :param minimal: only retrieve the fields required by the sync
+        :return: list of field names
+        """
+
+        if minimal:
+            return self.MINIMAL_SELECT + [f for f in additional_fields if f not in self.MINIMAL_SELECT]
+
         # default fields retrieved by the graph api
         # https://developer.microsoft.com/en-us/graph/docs/api-reference/v1.0/api/user_get?WT.mc_id=AZ-MVP-5003365#optional-query-parameters
         select = [
@@ -44,32 +115,168 @@ class AzureAd(object):
         # extend list with given additional fields
         select.extend(additional_fields)
 
-        logging.debug(f'Retrieve group members for azure ad group {group_id}')
-        # authorize request with the given token
-        headers = {'Authorization': f'Bearer {self.graph_token}'}
-        # select only certain fields from the user list
+        return select
+
+    def get_member_query(self, group_id, additional_fields=[], page_size=999, transitive=False):
+        """
+        returns the relative url, query parameters and headers to retrieve the members of a group.
+        in transitive mode the members of nested groups are resolved by graph, only users with the
+        minimal fields are returned and disabled users are already filtered by graph
+        https://learn.microsoft.com/en-us/graph/api/group-list-transitivemembers
+
+        :param group_id:
+        :param additional_fields: additional user fields to retrieve
+        :param page_size: number of members retrieved per request ($top)
+        :param transitive: resolve the members of nested groups
+        :return: tuple of relative url, parameter dictionary and header dictionary
+        """
+
+        if not transitive:
+            params = {
+                '$select': ','.join(self.get_member_select(additional_fields)),
+                '$top': page_size,
+            }
+            return f'/groups/{group_id}/members', params, {}
+
         params = {
-            '$select': ','.join(select),
+            '$select': ','.join(self.get_member_select(additional_fields, minimal=True)),
+            '$top': page_size,
+            # filtering on accountEnabled is an advanced query, it requires $count and the eventual consistency level
+            # https://learn.microsoft.com/en-us/graph/aad-advanced-queries
+            '$filter': 'accountEnabled eq true',
+            '$count': 'true',
         }
+        return f'/groups/{group_id}/transitiveMembers/microsoft.graph.user', params, {'ConsistencyLevel': 'eventual'}
 
-        r = requests.get(
-            url=f'https://graph.microsoft.com/v1.0/groups/{group_id}/members',
-            headers=headers,
-            params=params,
-        )
-        r.raise_for_status()
+    def get_group_members(self, group_id, additional_fields=[], page_size=999, transitive=False):
+        """
+        retrieve all azure ad group members page by page and yield
+        the enabled azure users as soon as each page arrives
+        :param group_id:
+        :param additional_fields: additional user fields to retrieve
+        :param page_size: number of members retrieved per request ($top)
+        :param transitive: resolve the members of nested groups
+        :return: generator of enabled azure users
+        """
+
+        logging.debug(f'Retrieve group members for azure ad group {group_id}')
+        # select only certain fields from the user list
+        url, params, headers = self.get_member_query(group_id, additional_fields, page_size, transitive)
+
+        found_members = False
+        for page in self.get_pages(url=f'{self.graph_url}{url}', params=params, headers=headers):
+            for m in self._enabled_members(page):
+                found_members = True
+                yield m
+
+        if not found_members:
+            raise ValueError(f'No members in group {group_id} found.')
+
+    def get_groups_members(self, group_ids, additional_fields=[], page_size=999, batch_size=20, transitive=False):
+        """
+        retrieve the members of multiple azure ad groups with graph json batching.
+        up to batch_size member requests, including the next pages of the groups, are
+        sent in a single $batch round trip
+        https://learn.microsoft.com/en-us/graph/json-batching
+
+        :param group_ids: list of azure ad group ids
+        :param additional_fields: additional user fields to retrieve
+        :param page_size: number of members retrieved per request ($top)
+        :param batch_size: number of requests per batch, graph allows up to 20
+        :param transitive: resolve the members of nested groups
+        :return: generator of (group id, enabled azure user) tuples
+        """
+
+        # list of pending (group id, relative url, attempt) requests
+        pending = []
+        headers = {}
+        for g in group_ids:
+            url, params, headers = self.get_member_query(g, additional_fields, page_size, transitive)
+            pending.append((g, f'{url}?{urlencode(params, safe="$,", quote_via=quote)}', 0))
+        found_members = {g: False for g in group_ids}
+
+        while pending:
+            batch = pending[:batch_size]
+            pending = pending[batch_size:]
+
+            requests = []
+            for i, (_, url, _) in enumerate(batch):
+                request = {'id': str(i), 'method': 'GET', 'url': url}
+                if headers:
+                    request['headers'] = headers
+                requests.append(request)
+
+            logging.debug(f'Retrieve group members for azure ad groups {", ".join([g for g, _, _ in batch])}')
+            r = self.session.post(
+                url=f'{self.graph_url}/$batch',
+                headers={'Authorization': f'Bearer {self.graph_token}'},
+                json={'requests': requests},
+                timeout=self.timeout,
+            )
+            r.raise_for_status()
+            registry.inc('http_response_bytes_total', len(r.content), client='graph')
+
+            # throttled requests of the batch are retried after the longest requested delay
+            retry_after = 0
+            for response in r.json().get('responses', []):
+                group_id, url, attempt = batch[int(response.get('id'))]
+                body = response.get('body') or {}
+                status = response.get('status', 500)
+
+                if status in RETRY_STATUS_CODES and attempt < self.retries:
+                    delay = (response.get('headers') or {}).get('Retry-After')
+                    delay = int(delay) if delay else self.backoff_factor * (2 ** attempt)
+                    logging.debug(f'Retry request for azure ad group {group_id} in {delay}s, status {status}')
+                    registry.inc('graph_batch_retries_total', status=status)
+                    retry_after = max(retry_after, delay)
+                    pending.append((group_id, url, attempt + 1))
+                    continue
+
+                if status >= 400:
+                    error = body.get('error', {}).get('message', body)
+                    message = f'Unable to retrieve members of azure ad group {group_id}: {status} {error}'
+                    # throttled or failed requests which exhausted their retries are retried by the next sync
+                    if status in RETRY_STATUS_CODES:
+                        raise HTTPError(message)
+                    raise ValueError(message)
+
+                for m in self._enabled_members(body):
+                    found_members[group_id] = True
+                    yield group_id, m
+
+                # continue with the next page of the group in one of the next batches
+                next_link = body.get('@odata.nextLink')
+                if next_link:
+                    if next_link.startswith(self.graph_url):
+                        next_link = next_link[len(self.graph_url):]
+                    pending.append((group_id, next_link, 0))
+
+            if retry_after:
+                time.sleep(retry_after)
+
+        for g, found in found_members.items():
+            if not found:
+                raise ValueError(f'No members in group {g} found.')
+
+    @staticmethod
+    def _enabled_members(page):
+        """
+        yield the enabled accounts of a retrieved member page
+        :param page: page dictionary returned by the graph api
+        :return: generator of enabled azure users
+        """
 
         # drop inactive accounts
         # filter queries arent supported for referenced properties (e.g. users in group)
         # so usingg $filter=accountEnabled eq true isnt working !
         # {"error":{"code":"Request_UnsupportedQuery","message":"The specified filter to the reference property query is currently not supported."
-        members = []
-        for m in r.json().get('value', []):
+        # only the transitive members cast to users support the filter as advanced query
+        for m in page.get('value', []):
+            # nested groups and other directory objects are returned as direct members too
+            odata_type = m.pop('@odata.type', '#microsoft.graph.user')
+            if odata_type != '#microsoft.graph.user':
+                logging.warning(f'Skip azure ad group member {m.get("id")} of type {odata_type}, '
+                                f'members of nested groups are only retrieved in transitive mode')
+                continue
             if m.get('accountEnabled') == True:
-                m.pop('@odata.type', None)
-                members.append(m)
-
-        if not members:
-            raise ValueError(f'No members in group {group_id} found.')
-
-        return members
\ No newline at end of file
+                yield m
@@ -0,0 +1,289 @@
+from util import atomic_write
+import logging
+import json
+import os
+
+
+class AzureAdDelta(object):
+    """
+        incremental azure ad client. the group memberships and user attributes are tracked
+        with graph delta queries, the delta links and the last known state are persisted
+        to disk so later sync cycles only retrieve the changes
+    """
+
+    # version of the persisted state, bump if the layout changes
+    STATE_VERSION = 1
+
+    # user fields required by the sync
+    # https://learn.microsoft.com/en-us/graph/api/user-delta
+    USER_FIELDS = [
+        'accountEnabled',
+        'id',
+        'mail',
+        'userPrincipalName',
+    ]
+
+    # graph error codes returned if a delta link is no longer valid
+    # and a full resync is required
+    RESYNC_ERRORS = ['syncStateNotFound', 'resyncRequired', 'syncStateInvalid']
+
+    def __init__(self, azuread, state_file):
+        """
+        initialize the delta client
+        :param azuread: azure ad client used to query the graph api
+        :param state_file: file to persist the delta links and the membership state in
+        """
+        self.azuread = azuread
+        self.state_file = state_file
+        self.state = self.load()
+
+    def load(self):
+        """
+        load the persisted delta state from disk
+        :return: state dictionary or None if there is no usable state
+        """
+
+        if not os.path.isfile(self.state_file):
+            return None
+
+        try:
+            with open(self.state_file) as file:
+                state = json.load(file)
+        except Exception as e:
+            logging.warning(f'Unable to load azure ad delta state {self.state_file}: {e}')
+            return None
+
+        if state.get('version') != self.STATE_VERSION:
+            return None
+
+        return state
+
+    def save(self):
+        """
+        atomically persist the delta state to disk, the file is only readable by the owner
+        :return:
+        """
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_file)), mode=0o0700, exist_ok=True)
+        atomic_write(self.state_file, json.dumps(self.state))
+
+    def refresh(self, group_ids, additional_fields=[]):
+        """
+        bring the membership state of the given groups up to date. if there is no valid
+        state, or the configured groups or fields changed, a full sync is executed
+        :param group_ids: list of azure ad group ids to track
+        :param additional_fields: additional user fields to track
+        :return:
+        """
+
+        # imported on use, the module is part of every mode but requests is only loaded by the azure modes
+        import requests
+
+        group_ids = sorted(set(group_ids))
+        fields = sorted(set(self.USER_FIELDS + list(additional_fields)))
+
+        if not self.state or self.state.get('groups') != group_ids or self.state.get('fields') != fields:
+            logging.info('No usable azure ad delta state found, execute full sync')
+            self.state = self._initial_state(group_ids=group_ids, fields=fields)
+
+        try:
+            self._sync()
+        except requests.HTTPError as e:
+            if not self._is_resync_error(e):
+                raise e
+            logging.warning(f'Azure ad delta link expired, execute full sync: {e}')
+            self.state = self._initial_state(group_ids=group_ids, fields=fields)
+            self._sync()
+
+        self.save()
+
+    def get_group_members(self, group_id, **kwargs):
+        """
+        yield the enabled azure users of the given group from the delta state.
+        the signature matches AzureAd.get_group_members, refresh() needs to be called first
+        :param group_id:
+        :return: generator of enabled azure users
+        """
+
+        found_members = False
+        for user_id in self.state['members'].get(group_id, []):
+            m = self.state['users'].get(user_id)
+            if m and m.get('accountEnabled') == True:
+                found_members = True
+                yield dict(m)
+
+        if not found_members:
+            raise ValueError(f'No members in group {group_id} found.')
+
+    def get_groups_members(self, group_ids, **kwargs):
+        """
+        yield the enabled azure users of all given groups from the delta state.
+        the signature matches AzureAd.get_groups_members, refresh() needs to be called first
+        :param group_ids: list of azure ad group ids
+        :return: generator of (group id, enabled azure user) tuples
+        """
+
+        for g in group_ids:
+            for m in self.get_group_members(group_id=g):
+                yield g, m
+
+    def _initial_state(self, group_ids, fields):
+        """
+        returns an empty state for the given groups and fields
+        :param group_ids:
+        :param fields:
+        :return: state dictionary
+        """
+
+        return {
+            'version': self.STATE_VERSION,
+            'groups': group_ids,
+            'fields': fields,
+            'groups_delta_link': None,
+            'users_delta_link': None,
+            'members': {g: [] for g in group_ids},
+            'users': {},
+        }
+
+    def _sync(self):
+        """
+        apply group and user changes retrieved with the delta queries to the state
+        :return:
+        """
+
+        self._sync_groups()
+        self._sync_users()
+
+        # retrieve users which joined a group but arent known yet
+        tracked = set()
+        for members in self.state['members'].values():
+            tracked.update(members)
+
+        for user_id in tracked - set(self.state['users']):
+            user = self._get_user(user_id)
+            if user:
+                self.state['users'][user_id] = user
+
+        # drop users which arent member in any tracked group anymore
+        for user_id in set(self.state['users']) - tracked:
+            del self.state['users'][user_id]
+
+    def _sync_groups(self):
+        """
+        retrieve membership changes of the tracked groups
+        :return:
+        """
+
+        url = self.state.get('groups_delta_link')
+        params = None
+        if not url:
+            url = f'{self.azuread.graph_url}/groups/delta'
+            params = {
+                '$select': 'members',
+                '$filter': ' or '.join([f"id eq '{g}'" for g in self.state['groups']]),
+            }
+
+        members = {g: set(m) for g, m in self.state['members'].items()}
+        changes = 0
+        for page in self.azuread.get_pages(url=url, params=params):
+            for g in page.get('value', []):
+                if g.get('id') not in members:
+                    continue
+                if '@removed' in g:
+                    logging.warning(f'Azure ad group {g.get("id")} was removed')
+                    members[g.get('id')] = set()
+                    continue
+                for m in g.get('members@delta', []):
+                    # nested groups and other directory objects are ignored
+                    if m.get('@odata.type', '#microsoft.graph.user') != '#microsoft.graph.user':
+                        continue
+                    changes += 1
+                    if '@removed' in m:
+                        members[g.get('id')].discard(m.get('id'))
+                    else:
+                        members[g.get('id')].add(m.get('id'))
+
+            if page.get('@odata.deltaLink'):
+                self.state['groups_delta_link'] = page.get('@odata.deltaLink')
+
+        logging.debug(f'Retrieved {changes} azure ad group membership changes')
+        self.state['members'] = {g: sorted(m) for g, m in members.items()}
+
+    def _sync_users(self):
+        """
+        retrieve attribute changes of all users and update the tracked users
+        :return:
+        """
+
+        url = self.state.get('users_delta_link')
+        initial = not url
+        params = None
+        if initial:
+            url = f'{self.azuread.graph_url}/users/delta'
+            params = {'$select': ','.join(self.state['fields'])}
+
+        tracked = set()
+        for members in self.state['members'].values():
+            tracked.update(members)
+
+        users = self.state['users']
+        changes = 0
+        for page in self.azuread.get_pages(url=url, params=params):
+            for u in page.get('value', []):
+                user_id = u.get('id')
+                if user_id not in tracked:
+                    continue
+                changes += 1
+                if '@removed' in u:
+                    users.pop(user_id, None)
+                    continue
+                # delta responses only contain changed properties, merge them with the known ones.
+                # unknown users are retrieved completely afterwards
+                if user_id not in users and not initial:
+                    continue
+                user = users.setdefault(user_id, {})
+                for k in self.state['fields']:
+                    if k in u:
+                        user[k] = u[k]
+
+            if page.get('@odata.deltaLink'):
+                self.state['users_delta_link'] = page.get('@odata.deltaLink')
+
+        logging.debug(f'Retrieved {changes} azure ad user changes')
+
+    def _get_user(self, user_id):
+        """
+        retrieve the tracked fields of a single user
+        :param user_id:
+        :return: user dictionary or None if the user doesnt exist
+        """
+
+        import requests
+
+        try:
+            for user in self.azuread.get_pages(
+                    url=f'{self.azuread.graph_url}/users/{user_id}',
+                    params={'$select': ','.join(self.state['fields'])}):
+                user.pop('@odata.context', None)
+                return user
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise e
+
+    def _is_resync_error(self, error):
+        """
+        returns true if the http error signals an invalid delta link
+        :param error: requests http error
+        :return:
+        """
+
+        if error.response is None:
+            return False
+        if error.response.status_code == 410:
+            return True
+        try:
+            code = error.response.json().get('error', {}).get('code')
+        except ValueError:
+            return False
+        return code in self.RESYNC_ERRORS
@@ -1,26 +1,76 @@
-from azure.storage.blob import ContainerClient
-from azure.identity import ClientSecretCredential
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .httpsession import create_session
+from metrics import registry
 import logging
+import threading
 
 class AzureContainer(object):
     """
         represent an azure blob container, used to download ssh keys
     """
 
-    def __init__(self, tenant_id, client_id, client_secret, storage_account_name, storage_account_container):
-        self.credentials = ClientSecretCredential(
-            tenant_id=tenant_id,
-            client_id=client_id,
-            client_secret=client_secret
-        )
+    # the blobs of the users are listed by their user principal name once the container
+    # holds at least this many blobs per user, otherwise the whole container is listed
+    PREFIX_LOOKUP_RATIO = 50
+    # in auto mode the container is listed again after this many prefix lookups to learn its size
+    PREFIX_LOOKUP_CYCLES = 24
+
+    def __init__(self, credentials, storage_account_name, storage_account_container, cache=None, max_concurrency=8):
+        self.credentials = credentials
+        # number of blobs with the ssh keys prefix, learned from the last full listing
+        self.container_size = None
+        # number of prefix lookups chosen in auto mode since the last full listing
+        self.prefix_lookups = 0
+        # optional BlobCache, only new or changed blobs are downloaded
+        self.cache = cache
+        # maximum number of parallel blob downloads
+        self.max_concurrency = max_concurrency
 
         self.account_url = f'https://{storage_account_name}.blob.core.windows.net'
         self.container = storage_account_container
-        self.client = ContainerClient(
-            account_url=self.account_url,
-            container_name=self.container,
-            credential=self.credentials
-        )
+        # created on first use, the storage sdk is only imported once the container is accessed
+        self._client = None
+        # shared by the per user listings, created on first use
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """
+        the container client, created on first use
+        :return: azure ContainerClient
+        """
+
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from azure.core.pipeline.transport import RequestsTransport
+                    from azure.storage.blob import ContainerClient
+
+                    self._client = ContainerClient(
+                        account_url=self.account_url,
+                        container_name=self.container,
+                        credential=self.credentials,
+                        # size the connection pool for the parallel downloads, retries are handled by the sdk
+                        transport=RequestsTransport(
+                            session=create_session(pool_size=self.max_concurrency, retries=0),
+                            session_owner=False
+                        )
+                    )
+        return self._client
+
+    @property
+    def executor(self):
+        """
+        the thread pool listing the blobs of the users, created on first use
+        :return: ThreadPoolExecutor
+        """
+
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        return self._executor
 
     def get_blobs(self, prefix=None, suffix=None):
         """
@@ -28,29 +78,144 @@ class AzureContainer(object):
 
 
         :param prefix:
-        :return: list of found blobs with name and last modified date
+        :return: list of found blobs with name, etag and last modified date
         """
         logging.debug(f'Retrieve blobs from {self.account_url}/{self.container}')
         blobs = self.client.list_blobs(name_starts_with=prefix)
 
         returned_blobs = []
+        listed = 0
         for b in blobs:
+            listed += 1
             if b.get('name').endswith(suffix):
-                returned_blobs.append({'name': b.get('name'), 'last_modified': b.get('last_modified')})
+                returned_blobs.append({
+                    'name': b.get('name'),
+                    'etag': b.get('etag'),
+                    'last_modified': b.get('last_modified'),
+                })
 
+        self.container_size = listed
+        self.prefix_lookups = 0
+        registry.set('blobs_listed', len(returned_blobs))
+        registry.inc('blob_lookups_total', strategy='list')
         if not returned_blobs:
             raise ValueError(f'No blobs found with prefix {prefix} and suffix {suffix} in {self.account_url}/{self.container}')
 
         return returned_blobs
 
-    def download_blob(self, name):
+    def get_user_blobs(self, user_principal_names, prefix=None, suffix=None):
+        """
+        return the blobs of the given users. instead of listing the whole container, the blobs
+        starting with the prefix and the user principal name are listed for each user in parallel
+
+        :param user_principal_names: list of user principal names
+        :param prefix:
+        :param suffix:
+        :return: list of found blobs with name, etag and last modified date
+        """
+
+        def list_user_blobs(upn):
+            return [b for b in self.client.list_blobs(name_starts_with=f'{prefix or ""}{upn}')
+                    if b.get('name').endswith(suffix)]
+
+        logging.debug(f'Retrieve blobs of {len(user_principal_names)} users from {self.account_url}/{self.container}')
+        user_principal_names = set(user_principal_names)
+        returned_blobs = {}
+        # a single user, e.g. from the pipeline, is listed in the calling thread
+        if len(user_principal_names) == 1:
+            listings = [list_user_blobs(upn) for upn in user_principal_names]
+        else:
+            listings = self.executor.map(list_user_blobs, user_principal_names)
+        # user principal names sharing a prefix list the same blobs, they are returned once
+        for blobs in listings:
+            for b in blobs:
+                returned_blobs[b.get('name')] = {
+                    'name': b.get('name'),
+                    'etag': b.get('etag'),
+                    'last_modified': b.get('last_modified'),
+                }
+
+        registry.inc('blob_lookups_total', len(user_principal_names), strategy='prefix')
+        return list(returned_blobs.values())
+
+    def get_lookup_strategy(self, user_count, strategy='auto'):
+        """
+        returns the strategy used to look up the blobs of the given number of users.
+        in auto mode the users are looked up by prefix once the container size learned from
+        a full listing exceeds PREFIX_LOOKUP_RATIO blobs per user. every PREFIX_LOOKUP_CYCLES
+        prefix lookups the container is listed again, so a shrunk container switches back
+
+        :param user_count: number of users whose blobs are looked up
+        :param strategy: auto, list or prefix
+        :return: list or prefix
         """
-        download the specified blob
+
+        if strategy != 'auto':
+            return strategy
+        if self.container_size is None or not user_count:
+            return 'list'
+        if self.container_size < user_count * self.PREFIX_LOOKUP_RATIO or self.prefix_lookups >= self.PREFIX_LOOKUP_CYCLES:
+            return 'list'
+        self.prefix_lookups += 1
+        return 'prefix'
+
+    def download_blob(self, name, version=None):
+        """
+        download the specified blob. if a cache is configured and the
+        blob version is known, cached blobs are returned from disk
 
         :param name: name of the blob to download
+        :param version: version of the blob, e.g. the etag or last modified date
         :return: string
         """
+
+        if self.cache and version:
+            content = self.cache.get(name=name, version=version)
+            if content is not None:
+                logging.debug(f'Use cached blob {self.account_url}/{self.container}/{name}')
+                registry.inc('blob_downloads_total', source='cache')
+                return content
+
         logging.debug(f'Download blob {self.account_url}/{self.container}/{name}')
         download = self.client.download_blob(name).readall()
+        registry.inc('blob_downloads_total', source='storage')
+        registry.inc('http_response_bytes_total', len(download), client='storage')
+        content = download.decode().strip()
+
+        if self.cache and version:
+            self.cache.put(name=name, version=version, content=content)
+
+        return content
+
+    def download_blobs(self, blobs, deadline=None):
+        """
+        download the given blobs in parallel, at most max_concurrency downloads run at the same time
+
+        :param blobs: list of blobs as returned by get_blobs
+        :param deadline: optional deadline of the sync cycle, the pending downloads are cancelled once it passed
+        :return: dictionary of blob names and their content, or the exception if the download failed
+        """
+
+        downloads = {}
+        if not blobs:
+            return downloads
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {}
+            for b in blobs:
+                if b.get('name') in downloads:
+                    continue
+                downloads[b.get('name')] = None
+                futures[executor.submit(self.download_blob, b.get('name'), b.get('etag'))] = b.get('name')
+
+            for f in as_completed(futures):
+                if deadline and deadline.expired():
+                    for pending in futures:
+                        pending.cancel()
+                    deadline.check()
+                try:
+                    downloads[futures[f]] = f.result()
+                except Exception as e:
+                    downloads[futures[f]] = e
 
-        return download.decode().strip()
+        return downloads
@@ -0,0 +1,95 @@
+from util import atomic_write
+import threading
+import hashlib
+import logging
+import os
+
+
+class BlobCache(object):
+    """
+        local content cache for downloaded blobs. entries are keyed by the blob name and
+        its version (etag or last modified date), so changed blobs are downloaded again.
+        the least recently used entries are evicted if the cache exceeds its maximum size
+    """
+
+    def __init__(self, directory, max_size=10 * 1024 * 1024):
+        """
+        initialize the blob cache
+        :param directory: directory to store the cached blobs in
+        :param max_size: maximum size of the cache in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        os.makedirs(self.directory, mode=0o0700, exist_ok=True)
+        self.size = sum([e.stat().st_size for e in os.scandir(self.directory) if e.is_file()])
+
+    def path(self, name, version):
+        """
+        returns the path of the cache entry for the given blob version
+        :param name: name of the blob
+        :param version: version of the blob, e.g. the etag
+        :return: path to the cache entry
+        """
+
+        key = hashlib.sha256(f'{name}\0{version}'.encode()).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def get(self, name, version):
+        """
+        return the cached content of the given blob version
+        :param name: name of the blob
+        :param version: version of the blob, e.g. the etag
+        :return: string or None if the blob version isnt cached
+        """
+
+        path = self.path(name=name, version=version)
+        try:
+            with open(path) as file:
+                content = file.read()
+        except FileNotFoundError:
+            return None
+
+        # update the modification time, the eviction drops the least recently used entries
+        os.utime(path)
+        return content
+
+    def put(self, name, version, content):
+        """
+        store the content of the given blob version
+        :param name: name of the blob
+        :param version: version of the blob, e.g. the etag
+        :param content: content of the blob
+        :return:
+        """
+
+        path = self.path(name=name, version=version)
+        atomic_write(path, content)
+
+        with self.lock:
+            self.size += len(content.encode())
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """
+        drop the least recently used entries until the cache is below 90% of its maximum size
+        :return:
+        """
+
+        entries = sorted(
+            [(e.stat().st_mtime, e.stat().st_size, e.path) for e in os.scandir(self.directory)
+             if e.is_file() and not e.name.endswith('.tmp')]
+        )
+        self.size = sum([size for _, size, _ in entries])
+
+        for _, size, path in entries:
+            if self.size <= self.max_size * 0.9:
+                break
+            logging.debug(f'Evict cached blob {path}')
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
@@ -0,0 +1,56 @@
+from metrics import registry
+from urllib.parse import urlsplit
+
+# status codes retried with an exponential backoff, graph returns 429 if requests are throttled
+# https://learn.microsoft.com/en-us/graph/throttling
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+def _record_response(response, *args, **kwargs):
+    # count the requests and their latency per host, retries are handled by urllib3 and
+    # only the final response is recorded. the body isnt touched, streamed downloads stay streamed
+    host = urlsplit(response.url).hostname
+    registry.inc('http_requests_total', host=host, method=response.request.method, status=response.status_code)
+    registry.observe('http_request_duration_seconds', response.elapsed.total_seconds(), host=host)
+
+
+def create_session(pool_size=10, retries=5, backoff_factor=1):
+    """
+    create a http session with a connection pool and a throttling aware retry policy.
+    retries use an exponential backoff and honour the Retry-After header
+
+    :param pool_size: maximum number of connections kept open per host
+    :param retries: maximum number of retries per request
+    :param backoff_factor: backoff factor, retries sleep {backoff factor} * (2 ** ({retry number} - 1)) seconds
+    :return: requests session
+    """
+
+    # requests is only imported once a session is required, modes without http dont pay for the import
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    import requests
+
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        # $batch requests are sent as post, they only read data and are safe to retry
+        allowed_methods=frozenset(['GET', 'POST']),
+        respect_retry_after_header=True,
+        # return the last response after all retries failed, raise_for_status reports the error
+        raise_on_status=False,
+    )
+
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip'})
+    session.hooks['response'].append(_record_response)
+
+    return session
@@ -0,0 +1,127 @@
+from collections import namedtuple
+from metrics import registry
+from util import atomic_write
+import threading
+import logging
+import json
+import time
+import os
+
+# compatible with azure.core.credentials.AccessToken, the azure sdk isnt imported to load cached tokens
+AccessToken = namedtuple('AccessToken', ['token', 'expires_on'])
+
+
+class CachedCredential(object):
+    """
+        wrap an azure credential and cache the retrieved access tokens until shortly before
+        they expire. the cache can be persisted to a file only readable by the owner, so a
+        restart doesnt need to acquire new tokens while the cached ones are still valid
+    """
+
+    def __init__(self, credential=None, cache_file=None, refresh_margin=300, credential_factory=None):
+        """
+        initialize the cached credential
+        :param credential: azure credential used to acquire new tokens
+        :param cache_file: optional file to persist the tokens in
+        :param refresh_margin: refresh tokens the given number of seconds before they expire
+        :param credential_factory: function creating the azure credential once the first token is acquired,
+                                   used instead of the credential
+        """
+        if credential is None and credential_factory is None:
+            raise ValueError('Either credential or credential_factory is required')
+        self.credential = credential
+        self.credential_factory = credential_factory
+        self.cache_file = cache_file
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+        self.tokens = self.load()
+
+    @classmethod
+    def from_client_secret(cls, tenant_id, client_id, client_secret, cache_file=None):
+        """
+        create a cached credential for a service principal with a client secret
+        :param tenant_id:
+        :param client_id:
+        :param client_secret:
+        :param cache_file: optional file to persist the tokens in
+        :return: CachedCredential
+        """
+
+        def create_credential():
+            # azure.identity is only imported if no cached token is valid anymore
+            from azure.identity import ClientSecretCredential
+            return ClientSecretCredential(
+                tenant_id=tenant_id,
+                client_id=client_id,
+                client_secret=client_secret
+            )
+
+        return cls(credential_factory=create_credential, cache_file=cache_file)
+
+    def get_token(self, *scopes, **kwargs):
+        """
+        return a cached access token for the given scopes, a new token is acquired
+        if there is no cached token or it expires within the refresh margin. a claims
+        challenge always acquires a new token, it replaces the rejected cached one
+        :param scopes: token scopes
+        :param kwargs: passed to the credential, e.g. claims or tenant_id
+        :return: AccessToken
+        """
+
+        key = ' '.join(scopes)
+        # tokens of other tenants are cached separately
+        if kwargs.get('tenant_id'):
+            key = f'{kwargs["tenant_id"]}/{key}'
+        with self.lock:
+            token = self.tokens.get(key)
+            if token and not kwargs.get('claims') and token.expires_on - self.refresh_margin > time.time():
+                registry.inc('token_requests_total', source='cache')
+                return token
+
+            logging.debug(f'Acquire new access token for {key}')
+            if self.credential is None:
+                self.credential = self.credential_factory()
+            with registry.timer('token_acquire_duration_seconds'):
+                token = self.credential.get_token(*scopes, **kwargs)
+            registry.inc('token_requests_total', source='azure')
+            self.tokens[key] = token
+            self.save()
+
+        return token
+
+    def load(self):
+        """
+        load the persisted tokens. the file is ignored if it is accessible by other users
+        :return: dictionary of scopes and access tokens
+        """
+
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return {}
+
+        stat = os.stat(self.cache_file)
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o0077:
+            logging.warning(f'Ignore token cache {self.cache_file}, the file is accessible by other users')
+            return {}
+
+        try:
+            with open(self.cache_file) as file:
+                return {k: AccessToken(v['token'], v['expires_on']) for k, v in json.load(file).items()}
+        except Exception as e:
+            logging.warning(f'Unable to load token cache {self.cache_file}: {e}')
+            return {}
+
+    def save(self):
+        """
+        atomically persist the tokens to the cache file, the file is only readable by the owner
+        :return:
+        """
+
+        if not self.cache_file:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), mode=0o0700, exist_ok=True)
+            atomic_write(self.cache_file,
+                         json.dumps({k: {'token': v.token, 'expires_on': v.expires_on} for k, v in self.tokens.items()}))
+        except Exception as e:
+            logging.warning(f'Unable to save token cache {self.cache_file}: {e}')
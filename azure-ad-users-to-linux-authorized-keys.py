@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+"""
+    print the managed ssh keys of a linux user, used as sshd AuthorizedKeysCommand.
+    the keys are read from the key store maintained by azure-ad-users-to-linux.
+
+    usage: azure-ad-users-to-linux-authorized-keys.py [--key-store PATH] USERNAME
+"""
+
+import sys
+
+from keystore import KeyStore
+
+# sshd executes the command on every login, the arguments are parsed by hand
+# as argparse alone takes longer to import than the lookup
+DEFAULT_KEY_STORE = '/var/lib/azure-ad-users-to-linux-keys/keys.db'
+
+
+def run(args):
+    """
+    lookup the ssh keys of the given user
+    :param args: command line arguments
+    """
+
+    key_store = DEFAULT_KEY_STORE
+    if len(args) == 3 and args[0] == '--key-store':
+        key_store = args[1]
+        args = args[2:]
+    if len(args) != 1 or args[0].startswith('-'):
+        raise ValueError(__doc__.strip().splitlines()[-1].strip())
+
+    for key in KeyStore(path=key_store).get(username=args[0]):
+        print(key)
+
+
+if __name__ == '__main__':
+    try:
+        run(sys.argv[1:])
+    except Exception as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
@@ -5,13 +5,21 @@
 """
 
 import click
+from click.core import ParameterSource
+import json
+import time
 import sys
-import requests
 import logging
-import time
 
-from az import AzureAd, AzureContainer
-from users import AdUser, sort_ad_users_unique, LinuxGroup, LinuxUser
+from az import AzureAd, AzureAdDelta, AzureContainer, BlobCache, CachedCredential, create_session, get_graph_scope
+from keystore import KeyStore
+from metrics import MetricsServer, registry
+from sync import Deadline, Pipeline, Planner, Scheduler, SnapshotPublisher, SnapshotSource, StateStore
+from users import accountdb, AdUser, AuthorizedKeysIndex, index_ssh_keys, sort_ad_users_unique, LinuxGroup, LinuxUser
+
+# exit codes of a single sync (--once), usage errors exit with 2
+EXIT_SYNC_FAILED = 1
+EXIT_USERS_FAILED = 3
 
 
 @click.command()
@@ -32,30 +40,142 @@ from users import AdUser, sort_ad_users_unique, LinuxGroup, LinuxUser
     help="How often should the sync be executed (in seconds)",
     show_default=True
 )
+@click.option(
+    '--sync-jitter',
+    required=False,
+    envvar='SYNC_JITTER',
+    type=click.FloatRange(0, 1),
+    default=0.1,
+    help="Fraction of the sync interval used to spread the syncs of different hosts",
+    show_default=True
+)
+@click.option(
+    '--sync-timeout',
+    required=False,
+    envvar='SYNC_TIMEOUT',
+    type=click.IntRange(0),
+    default=0,
+    help="Abort a sync if it takes longer than the given seconds, 0 disables the deadline",
+    show_default=True
+)
+@click.option(
+    '--once',
+    required=False,
+    envvar='SYNC_ONCE',
+    is_flag=True,
+    default=False,
+    help="Execute a single sync and exit, e.g. from a systemd timer or cron. Exits with 1 if the sync failed "
+         "and with 3 if some users couldnt be managed",
+    show_default=True
+)
+@click.option(
+    '--sync-mode',
+    required=False,
+    envvar='SYNC_MODE',
+    type=click.Choice(['sync', 'publish', 'consume']),
+    default='sync',
+    help="Sync from azure (sync), publish a snapshot of the azure users without changing the local system (publish) "
+         "or sync from a published snapshot without querying azure (consume)",
+    show_default=True
+)
+@click.option(
+    '--snapshot-location',
+    required=False,
+    envvar='SNAPSHOT_LOCATION',
+    help="The file path or http(s) url the snapshot is published to or consumed from",
+    show_default=True
+)
+@click.option(
+    '--snapshot-key',
+    required=False,
+    envvar='SNAPSHOT_KEY',
+    help="The secret used to sign and verify the snapshot",
+    show_default=True
+)
+@click.option(
+    '--snapshot-cache-file',
+    required=False,
+    envvar='SNAPSHOT_CACHE_FILE',
+    help="Keep the last consumed snapshot in the given file, unchanged snapshots arent transferred again and older "
+         "snapshots are rejected after a restart",
+    show_default=True
+)
+@click.option(
+    '--snapshot-max-age',
+    required=False,
+    envvar='SNAPSHOT_MAX_AGE',
+    type=click.IntRange(0),
+    default=0,
+    help="Reject snapshots published more than the given seconds ago, 0 disables the check",
+    show_default=True
+)
+@click.option(
+    '--http-pool-size',
+    required=False,
+    envvar='HTTP_POOL_SIZE',
+    type=click.IntRange(1),
+    default=10,
+    help="The maximum number of pooled connections to the azure graph api",
+    show_default=True
+)
+@click.option(
+    '--http-connect-timeout',
+    required=False,
+    envvar='HTTP_CONNECT_TIMEOUT',
+    type=click.FloatRange(0, min_open=True),
+    default=10,
+    help="The connect timeout of azure graph requests (in seconds)",
+    show_default=True
+)
+@click.option(
+    '--http-read-timeout',
+    required=False,
+    envvar='HTTP_READ_TIMEOUT',
+    type=click.FloatRange(0, min_open=True),
+    default=60,
+    help="The read timeout of azure graph requests (in seconds)",
+    show_default=True
+)
+@click.option(
+    '--http-retries',
+    required=False,
+    envvar='HTTP_RETRIES',
+    type=click.IntRange(0),
+    default=5,
+    help="How often throttled or failed azure graph requests are retried, with exponential backoff",
+    show_default=True
+)
 @click.option(
     '--tenant-id',
-    required=True,
+    required=False,
     envvar='AZURE_TENANT_ID',
     help="The azure tenant id",
     show_default=True
 )
 @click.option(
     '--client-id',
-    required=True,
+    required=False,
     envvar='AZURE_CLIENT_ID',
     help="The azure service principal client id",
     show_default=True
 )
 @click.option(
     '--client-secret',
-    required=True,
+    required=False,
     envvar='AZURE_CLIENT_SECRET',
     help="The azure service principal client secret",
     show_default=True
 )
+@click.option(
+    '--token-cache-file',
+    required=False,
+    envvar='TOKEN_CACHE_FILE',
+    help="Persist the azure access tokens in the given file, the file is only readable by the owner",
+    show_default=True
+)
 @click.option(
     '--azure-ad-groups',
-    required=True,
+    required=False,
     envvar='AZURE_AD_GROUPS',
     help="A space separated list of azure ad group ids to get users from",
     show_default=True,
@@ -69,20 +189,97 @@ from users import AdUser, sort_ad_users_unique, LinuxGroup, LinuxUser
     default='userPrincipalName',
     show_default=True
 )
+@click.option(
+    '--azure-ad-page-size',
+    required=False,
+    envvar='AZURE_AD_PAGE_SIZE',
+    type=click.IntRange(1, 999),
+    help="The number of group members retrieved per azure graph request",
+    default=999,
+    show_default=True
+)
+@click.option(
+    '--azure-ad-batch-size',
+    required=False,
+    envvar='AZURE_AD_BATCH_SIZE',
+    type=click.IntRange(1, 20),
+    help="The number of group member requests combined in a single azure graph batch request",
+    default=20,
+    show_default=True
+)
+@click.option(
+    '--azure-ad-transitive',
+    required=False,
+    envvar='AZURE_AD_TRANSITIVE',
+    is_flag=True,
+    default=False,
+    help="Retrieve the members of nested groups, only the fields required by the sync are retrieved",
+    show_default=True
+)
+@click.option(
+    '--azure-ad-graph-url',
+    required=False,
+    envvar='AZURE_AD_GRAPH_URL',
+    help="The base url of the azure graph api, e.g. for national clouds. The token scope is derived from its host",
+    default='https://graph.microsoft.com/v1.0',
+    show_default=True
+)
+@click.option(
+    '--azure-ad-delta-state-file',
+    required=False,
+    envvar='AZURE_AD_DELTA_STATE_FILE',
+    help="Enable incremental syncs with azure graph delta queries and persist the delta state in the given file",
+    show_default=True
+)
 @click.option(
     '--storage-account-name',
-    required=True,
+    required=False,
     envvar='STORAGE_ACCOUNT_NAME',
     help="The name of the storage account containing the users public ssh keys",
     show_default=True
 )
 @click.option(
     '--storage-account-container',
-    required=True,
+    required=False,
     envvar='STORAGE_ACCOUNT_CONTAINER',
     help="The name oof the blob container in the storage account which contains the users public ssh keys",
     show_default=True
 )
+@click.option(
+    '--blob-cache-dir',
+    required=False,
+    envvar='BLOB_CACHE_DIR',
+    help="Cache downloaded ssh keys in the given directory, only new or changed keys are downloaded",
+    show_default=True
+)
+@click.option(
+    '--blob-cache-size',
+    required=False,
+    envvar='BLOB_CACHE_SIZE',
+    type=click.IntRange(1),
+    default=10,
+    help="The maximum size of the ssh key cache (in MiB)",
+    show_default=True
+)
+@click.option(
+    '--max-concurrent-downloads',
+    required=False,
+    envvar='MAX_CONCURRENT_DOWNLOADS',
+    type=click.IntRange(1),
+    default=8,
+    help="The maximum number of ssh keys downloaded in parallel",
+    show_default=True
+)
+@click.option(
+    '--blob-lookup-strategy',
+    required=False,
+    envvar='BLOB_LOOKUP_STRATEGY',
+    type=click.Choice(['auto', 'list', 'prefix']),
+    default='auto',
+    help="Look up the ssh keys by listing the whole container, by listing the user principal name prefix of each "
+         "user, or choose automatically by the ratio of container size to user count.",
+    show_default=True
+)
 @click.option(
     '--ssh-keys-prefix',
     envvar='SSH_KEYS_PREFIX',
@@ -113,12 +310,116 @@ from users import AdUser, sort_ad_users_unique, LinuxGroup, LinuxUser
     show_default=True,
     multiple=True
 )
-def run(loglevel, sync_every,
-        tenant_id, client_id, client_secret,
-        azure_ad_groups, azure_ad_username_field,
+@click.option(
+    '--authorized-keys-index-file',
+    envvar='AUTHORIZED_KEYS_INDEX_FILE',
+    required=False,
+    help="Persist the state of the written authorized keys files, unchanged files arent read again.",
+    show_default=True
+)
+@click.option(
+    '--apply-workers',
+    envvar='APPLY_WORKERS',
+    required=False,
+    type=click.IntRange(1),
+    default=4,
+    help="The number of users whose home directories and authorized keys files are managed in parallel.",
+    show_default=True
+)
+@click.option(
+    '--chunk-size',
+    envvar='CHUNK_SIZE',
+    required=False,
+    type=click.IntRange(1),
+    default=1000,
+    help="The number of users planned and applied at once, also limits the number of users waiting between "
+         "the pipeline stages. Only with --pipeline, without it all users are held in memory at once.",
+    show_default=True
+)
+@click.option(
+    '--pipeline',
+    envvar='SYNC_PIPELINE',
+    is_flag=True,
+    default=False,
+    help="Stream the users through the sync, the azure ad groups and the storage account are retrieved at the "
+         "same time and users are applied as soon as their ssh keys are downloaded. Only in sync mode.",
+    show_default=True
+)
+@click.option(
+    '--key-store',
+    envvar='KEY_STORE',
+    required=False,
+    help="Maintain the ssh keys of the managed users in the given key store, read by the sshd AuthorizedKeysCommand.",
+    show_default=True
+)
+@click.option(
+    '--manage-authorized-keys-files/--no-manage-authorized-keys-files',
+    envvar='MANAGE_AUTHORIZED_KEYS_FILES',
+    default=True,
+    help="Write the ssh keys to the authorized keys files in the users home directories.",
+    show_default=True
+)
+@click.option(
+    '--state-file',
+    envvar='STATE_FILE',
+    required=False,
+    help="Persist the applied state of the managed users, users in sync are skipped and interrupted syncs are resumed.",
+    show_default=True
+)
+@click.option(
+    '--list-disabled-users',
+    is_flag=True,
+    default=False,
+    help="Print the users disabled by the sync as json and exit, requires the state file.",
+    show_default=True
+)
+@click.option(
+    '--metrics-textfile',
+    envvar='METRICS_TEXTFILE',
+    required=False,
+    help="Write the metrics after each sync to the given file, e.g. for the node exporter textfile collector.",
+    show_default=True
+)
+@click.option(
+    '--metrics-port',
+    envvar='METRICS_PORT',
+    required=False,
+    type=click.IntRange(0, 65535),
+    default=0,
+    help="Serve the metrics on http://METRICS_ADDRESS:METRICS_PORT/metrics, 0 disables the endpoint.",
+    show_default=True
+)
+@click.option(
+    '--metrics-address',
+    envvar='METRICS_ADDRESS',
+    required=False,
+    default='127.0.0.1',
+    help="The address the metrics endpoint listens on.",
+    show_default=True
+)
+@click.option(
+    '--dry-run',
+    '--plan',
+    'dry_run',
+    envvar='SYNC_DRY_RUN',
+    is_flag=True,
+    default=False,
+    help="Print the planned changes as json and exit without applying them.",
+    show_default=True
+)
+def run(loglevel, sync_every, sync_jitter, sync_timeout, once,
+        sync_mode, snapshot_location, snapshot_key, snapshot_cache_file, snapshot_max_age,
+        http_pool_size, http_connect_timeout, http_read_timeout, http_retries,
+        tenant_id, client_id, client_secret, token_cache_file,
+        azure_ad_groups, azure_ad_username_field, azure_ad_page_size, azure_ad_batch_size,
+        azure_ad_transitive, azure_ad_graph_url, azure_ad_delta_state_file,
         storage_account_name, storage_account_container,
+        blob_cache_dir, blob_cache_size, max_concurrent_downloads, blob_lookup_strategy,
         ssh_keys_prefix, ssh_keys_suffix,
-        linux_group_name, additional_linux_groups):
+        linux_group_name, additional_linux_groups, authorized_keys_index_file, apply_workers, chunk_size, pipeline,
+        key_store, manage_authorized_keys_files, state_file, list_disabled_users,
+        metrics_textfile, metrics_port, metrics_address,
+        dry_run):
     """
     synchronize azure ad users with local user accounts
     """
@@ -131,15 +432,84 @@ def run(loglevel, sync_every,
     logging.getLogger('urllib3').setLevel(logging.ERROR)
     logging.getLogger('msal').setLevel(logging.ERROR)
 
-    # enter inifite loop
-    while True:
+    # the state of the applied users is kept between the sync cycles and restarts
+    state = StateStore(path=state_file) if state_file else None
+
+    if list_disabled_users:
+        if not state:
+            raise click.UsageError('--state-file is required to list the disabled users')
+        click.echo(json.dumps(state.disabled_users(), indent=2))
+        return
+
+    # a consumer reads the users from the published snapshot instead of querying azure,
+    # all other modes require the azure configuration
+    if sync_mode in ['publish', 'consume']:
+        if not snapshot_location or not snapshot_key:
+            raise click.UsageError(f'--snapshot-location and --snapshot-key are required in {sync_mode} mode')
+    if sync_mode in ['sync', 'publish']:
+        for option, value in [('--tenant-id', tenant_id), ('--client-id', client_id),
+                              ('--client-secret', client_secret), ('--azure-ad-groups', azure_ad_groups),
+                              ('--storage-account-name', storage_account_name),
+                              ('--storage-account-container', storage_account_container)]:
+            if not value:
+                raise click.UsageError(f'{option} is required in {sync_mode} mode')
+        # the group delta query only tracks the direct members
+        if azure_ad_transitive and azure_ad_delta_state_file:
+            raise click.UsageError('--azure-ad-transitive cant be combined with --azure-ad-delta-state-file')
+    # the publisher requires all users at once, consumers dont query azure
+    if pipeline and sync_mode != 'sync':
+        raise click.UsageError('--pipeline is only supported in sync mode')
+    # only the pipeline applies the users in chunks, reject the option instead of ignoring it
+    if not pipeline and click.get_current_context().get_parameter_source('chunk_size') != ParameterSource.DEFAULT:
+        raise click.UsageError('--chunk-size is only supported with --pipeline')
+
+    snapshot_publisher = None
+    snapshot_source = None
+    # file snapshots dont require a http session
+    snapshot_session = None
+    if snapshot_location and snapshot_location.startswith(('http://', 'https://')):
+        snapshot_session = create_session(pool_size=1, retries=http_retries)
+    if sync_mode == 'publish':
+        snapshot_publisher = SnapshotPublisher(
+            location=snapshot_location,
+            key=snapshot_key,
+            session=snapshot_session,
+            timeout=(http_connect_timeout, http_read_timeout)
+        )
+    elif sync_mode == 'consume':
+        snapshot_source = SnapshotSource(
+            location=snapshot_location,
+            key=snapshot_key,
+            cache_file=snapshot_cache_file,
+            max_age=snapshot_max_age,
+            session=snapshot_session,
+            timeout=(http_connect_timeout, http_read_timeout)
+        )
+
+    azad = None
+    azcontainer = None
+    if sync_mode in ['sync', 'publish']:
+        # the credential is shared by all azure clients, access tokens are cached
+        # and only refreshed shortly before they expire
+        credentials = CachedCredential.from_client_secret(
+            tenant_id=tenant_id,
+            client_id=client_id,
+            client_secret=client_secret,
+            cache_file=token_cache_file
+        )
+
         # initialize azure ad client
         try:
             azad = AzureAd(
-                tenant_id=tenant_id,
-                client_id=client_id,
-                client_secret=client_secret
+                credentials=credentials,
+                session=create_session(pool_size=http_pool_size, retries=http_retries),
+                timeout=(http_connect_timeout, http_read_timeout),
+                retries=http_retries,
+                graph_url=azure_ad_graph_url
             )
+            # in delta mode only changes since the last sync are retrieved from azure ad
+            if azure_ad_delta_state_file:
+                azad = AzureAdDelta(azuread=azad, state_file=azure_ad_delta_state_file)
         except Exception as e:
             logging.error(f'Unable to connect to Azure AD')
             raise e
@@ -147,53 +517,112 @@ def run(loglevel, sync_every,
         # intialize storage account client
         try:
             azcontainer = AzureContainer(
-                tenant_id=tenant_id,
-                client_id=client_id,
-                client_secret=client_secret,
+                credentials=credentials,
                 storage_account_name=storage_account_name,
-                storage_account_container=storage_account_container
+                storage_account_container=storage_account_container,
+                cache=BlobCache(directory=blob_cache_dir, max_size=blob_cache_size * 1024 * 1024) if blob_cache_dir else None,
+                max_concurrency=max_concurrent_downloads
             )
         except Exception as e:
             logging.error(f'Unable to connect to Azure Storage Account')
             raise e
 
-        # ensure local managed group exists to identify user accounts managed by azure-ad-users-to-linux
+    # the index of the written authorized keys files is kept between the sync cycles
+    authorized_keys_index = AuthorizedKeysIndex(index_file=authorized_keys_index_file) if authorized_keys_index_file else None
+    # the key store answers the sshd authorized keys command, no home directories need to be written
+    keystore = KeyStore(path=key_store) if key_store else None
+
+    # the sync timeout is checked between the phases and tasks of a cycle, hung requests end with the http timeouts
+    deadline = Deadline()
+
+    def phase(name):
+        # observe the duration of a sync phase, no phase starts once the cycle deadline passed
+        deadline.check()
+        return registry.timer('sync_phase_duration_seconds', phase=name)
+
+    def prepare_azure():
+        """
+        acquire the access token and retrieve the azure ad changes in delta mode
+        """
+
+        # acquire the access token upfront, its shared by all azure requests of the cycle
+        with phase('token'):
+            credentials.get_token(get_graph_scope(azure_ad_graph_url))
+
+        if azure_ad_delta_state_file:
+            with phase('graph_refresh'):
+                try:
+                    azad.refresh(group_ids=azure_ad_groups, additional_fields=[azure_ad_username_field])
+                except Exception as e:
+                    logging.error(f'Unable to retrieve azure ad changes')
+                    raise e
+
+    def get_members():
+        """
+        retrieve the members of all groups with batched requests, streamed page by page
+        :return: generator of (group id, azure user dictionary) tuples
+        """
+
         try:
-            azure_ad_users_to_linux_managed_group = LinuxGroup(name=linux_group_name)
-            azure_ad_users_to_linux_managed_group.create()
+            for g, m in azad.get_groups_members(group_ids=azure_ad_groups,
+                                                additional_fields=[azure_ad_username_field],
+                                                page_size=azure_ad_page_size,
+                                                batch_size=azure_ad_batch_size,
+                                                transitive=azure_ad_transitive):
+                deadline.check()
+                yield g, m
         except Exception as e:
-            logging.error(f'Unable to create linux group {linux_group_name}')
+            logging.error(f'Unable to retrieve members of azure ad groups {", ".join(azure_ad_groups)}')
             raise e
 
-        # retrieve azure ad users from the specified groups
-        azure_ad_users = []
-        for g in azure_ad_groups:
-            group_members = []
-            try:
-                group_members = azad.get_group_members(group_id=g, additional_fields=[azure_ad_username_field])
-                for m in group_members:
-                    # setup ad user object
-                    aduser = AdUser(**m)
-                    # add aduser to the retrieved members
-                    azure_ad_users.append(aduser)
-            except Exception as e:
-                logging.error(f'Unable to retrieve members of azure ad group {g}')
-                raise e
+    def fetch_linux_users():
+        """
+        retrieve the desired linux users and their ssh keys from azure
+        :return: list of LinuxUser
+        """
+
+        prepare_azure()
+
+        with phase('graph_fetch'):
+            # retrieve azure ad users from the specified groups, process them as they arrive
+            azure_ad_users = []
+            for g, m in get_members():
+                # setup ad user object, remember the group the user was retrieved from
+                aduser = AdUser(source_groups=[g], username_field=azure_ad_username_field, **m)
+                # add aduser to the retrieved members
+                azure_ad_users.append(aduser)
         # sort all members and drop duplicates
         azure_ad_users = sort_ad_users_unique(azure_ad_users)
 
         # retrieve ssh keys for each of the retrieved azure ad users
         # from keyvault
-        blobs = []
-        try:
-            blobs = azcontainer.get_blobs(prefix=ssh_keys_prefix, suffix=ssh_keys_suffix)
-        except Exception as e:
-            logging.warning(e)
+        with phase('blob_list'):
+            blobs = []
+            try:
+                # large containers shared with other tenants are only listed by the users prefixes
+                if azcontainer.get_lookup_strategy(user_count=len(azure_ad_users), strategy=blob_lookup_strategy) == 'prefix':
+                    blobs = azcontainer.get_user_blobs(
+                        user_principal_names=[u.userPrincipalName for u in azure_ad_users
+                                              if getattr(u, 'userPrincipalName', None)],
+                        prefix=ssh_keys_prefix,
+                        suffix=ssh_keys_suffix
+                    )
+                else:
+                    blobs = azcontainer.get_blobs(prefix=ssh_keys_prefix, suffix=ssh_keys_suffix)
+            except Exception as e:
+                logging.warning(e)
+
+        # index the ssh keys by user principal name once, instead of matching
+        # all blobs for every user. each blob is assigned to a single retrieved user
+        ssh_keys_index = index_ssh_keys(blobs=blobs, ssh_keys_prefix=ssh_keys_prefix, ssh_keys_suffix=ssh_keys_suffix,
+                                        user_principal_names=set([u.userPrincipalName for u in azure_ad_users]))
 
         # with all information retrieved from azure ad and storage accounts
         # lets setup the linux user objects. the linux user objects
         # contain the public key files username etc
+
         linux_users = []
+        linux_users_keys = []
         for u in azure_ad_users:
             # set linux user object with a hopefully valid linux username ;-)
             try:
@@ -201,61 +630,240 @@ def run(loglevel, sync_every,
             except Exception as e:
                 logging.warning(f'Unable to create linux user object: {e}')
                 continue
+            lu.user_principal_name = getattr(u, 'userPrincipalName', None)
+            lu.object_id = getattr(u, 'id', None)
+
+            logging.debug(f'Azure ad user {lu.user_principal_name} retrieved from groups '
+                          f'{", ".join(getattr(u, "source_groups", []))}')
 
             # retrieve ssh keys for the linux user
-            valid_keys = u.get_valid_ssh_keys(ssh_keys_suffix=ssh_keys_suffix, ssh_keys_prefix=ssh_keys_prefix)
-            keys = [k for k in blobs if valid_keys.search(k.get('name', ''))]
+            keys = u.get_ssh_keys(ssh_keys_index=ssh_keys_index)
             # if no keys are found in the storage account
             if not keys:
-                logging.warning(f'No public ssh keys found for {getattr(u, "userPrincipalName", None)}')
-            else:
-                for k in keys:
-                    try:
-                        lu.ssh_keys.append(azcontainer.download_blob(k.get('name')))
-                    except Exception as e:
-                        lu.manage_ssh_keys = False
-                        logging.warning(f'Unable to download ssh pub key {k}: {e}')
+                logging.warning(f'No public ssh keys found for {lu.user_principal_name}')
 
             # add linux user with valid username and ssh key to
             # linux users list
             linux_users.append(lu)
+            linux_users_keys.append((lu, keys))
 
+        # download the ssh keys of all users in parallel
+        with phase('key_download'):
+            downloads = azcontainer.download_blobs(blobs=[k for _, keys in linux_users_keys for k in keys],
+                                                   deadline=deadline)
+        for lu, keys in linux_users_keys:
+            for k in keys:
+                if isinstance(downloads.get(k.get('name')), Exception):
+                    lu.manage_ssh_keys = False
+                    logging.warning(f'Unable to download ssh pub key {k}: {downloads.get(k.get("name"))}')
+                else:
+                    lu.ssh_keys.append(downloads.get(k.get('name')))
 
-        # first loop trough all linux users
-        # create the user if it not exists
-        # add the retrieved ssh keys
-        # add user to additional user groups
-        for u in linux_users:
-            try:
-                # check if the user already exists, if it exists make sure user is member in the managed group
-                u.check_managed_user(managed_group=azure_ad_users_to_linux_managed_group.name)
-                # create user if it doesnt exist
-                u.create()
-                # set authorized keys
-                u.authorized_keys()
-                # add user to groups
-                u.group_memberships(managed_group=azure_ad_users_to_linux_managed_group.name, additional_groups=additional_linux_groups)
-                # enable user login shell
-                u.login_shell()
-            except Exception as e:
-                logging.warning(f'Unable to manage user {u.username}: {e}')
-
-        # with the user managed and setup
-        # get all users in the managed group
-        linux_users_in_managed_group = []
-        for u in azure_ad_users_to_linux_managed_group.get_members():
-            linux_users_in_managed_group.append(LinuxUser(username=u))
-
-        # pop all users which should be managed from the list
-        # the remaining user accounts need to be disabled
-        linux_users_in_managed_group_but_not_in_azure_ad = \
-            [u for u in linux_users_in_managed_group if u.username not in [e.username for e in linux_users]]
-        for u in linux_users_in_managed_group_but_not_in_azure_ad:
-            logging.warning(f'Disabling user {u.username}')
-            u.login_shell(login_shell='/sbin/nologin')
-
-        # sleep for the given time
-        time.sleep(int(sync_every))
+        return linux_users
+
+    # number of users retrieved by the previous pipeline cycle, the pipeline chooses the
+    # blob lookup strategy before the users are known
+    previous_cycle = {'users': 0}
+
+    def pipeline_cycle():
+        """
+        execute a single sync cycle as pipeline, the stages overlap
+        :return: tuple of the desired linux usernames, the planned changes and the usernames with failed changes
+        """
+
+        prepare_azure()
+        accountdb.refresh()
+
+        planner = Planner(
+            managed_group=linux_group_name,
+            additional_groups=additional_linux_groups,
+            authorized_keys_index=authorized_keys_index,
+            manage_authorized_keys=manage_authorized_keys_files,
+            state=state,
+            workers=apply_workers,
+            deadline=deadline
+        )
+        get_user_blobs = None
+        if azcontainer.get_lookup_strategy(user_count=previous_cycle['users'], strategy=blob_lookup_strategy) == 'prefix':
+            get_user_blobs = lambda upn: azcontainer.get_user_blobs(
+                user_principal_names=[upn], prefix=ssh_keys_prefix, suffix=ssh_keys_suffix
+            )
+
+        # the key store is updated with each applied chunk, the users are released afterwards
+        keystore_users = set()
+        on_applied = None
+        if keystore:
+            on_applied = lambda linux_users: keystore_users.update(update_keystore(linux_users, prune=False))
+
+        result = Pipeline(
+            get_members=get_members,
+            get_blobs=lambda: azcontainer.get_blobs(prefix=ssh_keys_prefix, suffix=ssh_keys_suffix),
+            get_user_blobs=get_user_blobs,
+            download_blob=azcontainer.download_blob,
+            planner=planner,
+            username_field=azure_ad_username_field,
+            ssh_keys_prefix=ssh_keys_prefix,
+            ssh_keys_suffix=ssh_keys_suffix,
+            max_concurrent_downloads=max_concurrent_downloads,
+            queue_size=chunk_size,
+            chunk_size=chunk_size,
+            on_applied=on_applied,
+            deadline=deadline
+        ).run(apply=not dry_run)
+        previous_cycle['users'] = len(result[0])
+
+        if keystore and not dry_run:
+            with phase('keystore'):
+                removed = keystore.prune(usernames=keystore_users)
+            logging.debug(f'Removed {removed} users from key store {key_store}')
+        return result
+
+    def sync_cycle():
+        """
+        execute a single sync cycle
+        :return: list of the usernames which couldnt be managed
+        """
+
+        if pipeline:
+            _, changes, failed = pipeline_cycle()
+            if dry_run:
+                click.echo(json.dumps([c._asdict() for c in changes], indent=2))
+                return []
+            for u in failed:
+                logging.warning(f'Unable to manage user {u}')
+            return list(failed)
+
+        if snapshot_source:
+            # consumers read the users from the snapshot published by the producer
+            with phase('snapshot'):
+                try:
+                    linux_users = snapshot_source.get_users()
+                except Exception as e:
+                    logging.error(f'Unable to retrieve snapshot from {snapshot_location}')
+                    raise e
+        else:
+            linux_users = fetch_linux_users()
+
+        # the producer only distributes the users, the local system isnt changed
+        if snapshot_publisher:
+            if dry_run:
+                click.echo(json.dumps([{'username': u.username, 'userPrincipalName': u.user_principal_name,
+                                        'ssh_keys': len(u.ssh_keys)} for u in linux_users], indent=2))
+                return []
+            with phase('snapshot'):
+                snapshot_publisher.publish(linux_users=linux_users)
+            return []
+
+        # load the passwd and group databases once per cycle, all user and group
+        # lookups are served from this snapshot
+        accountdb.refresh()
+
+        # the planner compares the users retrieved from azure with the local system
+        # and computes the changes required to reconcile them
+        planner = Planner(
+            managed_group=linux_group_name,
+            additional_groups=additional_linux_groups,
+            authorized_keys_index=authorized_keys_index,
+            manage_authorized_keys=manage_authorized_keys_files,
+            state=state,
+            workers=apply_workers,
+            deadline=deadline
+        )
+
+        # ensure local managed group exists to identify user accounts managed by azure-ad-users-to-linux
+        with phase('plan'):
+            changes = planner.plan_group()
+
+            # plan the changes of all linux users
+            # create the user if it not exists
+            # add the retrieved ssh keys
+            # add user to additional user groups
+            changes.extend(planner.plan_users(linux_users=linux_users))
+
+        # all users in the managed group which arent retrieved
+        # from azure ad anymore need to be disabled
+        with phase('disable'):
+            changes.extend(planner.plan_disable(usernames=set([u.username for u in linux_users])))
+
+        # print the plan without applying it
+        if dry_run:
+            click.echo(json.dumps([c._asdict() for c in changes], indent=2))
+            return []
+
+        # apply only the planned changes
+        with phase('apply'):
+            failed = list(planner.apply(changes=changes))
+            planner.prune(usernames=set([u.username for u in linux_users]))
+        for u in failed:
+            logging.warning(f'Unable to manage user {u}')
+
+        update_keystore(linux_users)
+        return failed
+
+    def update_keystore(linux_users, prune=True):
+        """
+        update the key store with the ssh keys of the given linux users
+        :param prune: remove all other users from the key store
+        :return: set of usernames written or kept in the key store
+        """
+
+        if not keystore:
+            return set()
+
+        # only members of the managed group are served from the key store, the keys of
+        # users whose keys couldnt be downloaded are kept as they are
+        managed_users = set(LinuxGroup(name=linux_group_name).get_members() or [])
+        ssh_keys = {u.username: u.ssh_keys for u in linux_users if u.username in managed_users and u.manage_ssh_keys}
+        keep = [u.username for u in linux_users if u.username in managed_users and not u.manage_ssh_keys]
+        with phase('keystore'):
+            changed = keystore.update(ssh_keys=ssh_keys, keep=keep, prune=prune)
+        logging.debug(f'Updated {changed} users in key store {key_store}')
+        return set(ssh_keys) | set(keep)
+
+    def instrumented_sync_cycle():
+        """
+        execute a single sync cycle and export its metrics
+        :return: list of the usernames which couldnt be managed
+        """
+
+        try:
+            with registry.timer('sync_duration_seconds'):
+                failed = sync_cycle()
+            registry.inc('syncs_total', result='success')
+            registry.set('last_success_timestamp_seconds', time.time())
+            return failed
+        except Exception as e:
+            registry.inc('syncs_total', result='failure')
+            raise e
+        finally:
+            if metrics_textfile:
+                try:
+                    registry.write_textfile(path=metrics_textfile)
+                except Exception as e:
+                    logging.warning(f'Unable to write metrics to {metrics_textfile}: {e}')
+
+    # a dry run only plans a single cycle
+    if dry_run:
+        sync_cycle()
+        return
+
+    scheduler = Scheduler(interval=int(sync_every), jitter=sync_jitter, timeout=sync_timeout, deadline=deadline)
+
+    # a single sync exits as soon as the cycle completed, the timer or cron invoking it
+    # spreads the hosts. the metrics are only written to the textfile
+    if once:
+        result = {}
+        if not scheduler.run_once(cycle=lambda: result.update(failed=instrumented_sync_cycle())):
+            sys.exit(EXIT_SYNC_FAILED)
+        if result['failed']:
+            sys.exit(EXIT_USERS_FAILED)
+        return
+
+    if metrics_port:
+        MetricsServer(registry=registry, port=metrics_port, address=metrics_address).start()
+
+    # execute the sync cycles until the process is stopped
+    scheduler.run(cycle=instrumented_sync_cycle)
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,4 @@
+from .fakecli import FakeCli
+from .fakecontainer import FakeAzureContainer, FakeContainerClient
+from .fakegraph import FakeGraph
+from .scenarios import DEFAULT_SCENARIOS, SCENARIOS, get_scenario
\ No newline at end of file
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""
+    benchmark a sync cycle against a local fake graph api, blob container and account database
+"""
+
+from .scenarios import DEFAULT_SCENARIOS, SCENARIOS
+import subprocess
+import platform
+import datetime
+import click
+import json
+import sys
+import os
+
+# metrics compared against the baseline, lower is better
+COMPARED_METRICS = ['wall_time', 'subprocesses', 'http_requests', 'peak_rss_kib']
+
+
+@click.command()
+@click.option(
+    '--scenario',
+    'scenarios',
+    type=click.Choice(list(SCENARIOS)),
+    multiple=True,
+    help=f"The scenarios to execute  [default: {', '.join(DEFAULT_SCENARIOS)}]"
+)
+@click.option(
+    '--output',
+    required=False,
+    help="Store the results as json in the given file",
+)
+@click.option(
+    '--baseline',
+    required=False,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Compare the results with the results stored in the given file",
+)
+def run(scenarios, output, baseline):
+    """
+    execute the benchmark scenarios, each in its own process
+    """
+
+    results = []
+    for name in scenarios or DEFAULT_SCENARIOS:
+        click.echo(f'Run scenario {name}', err=True)
+        process = subprocess.run(
+            [sys.executable, '-m', 'benchmark.runner', name],
+            stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+        if process.returncode != 0:
+            raise click.ClickException(f'Scenario {name} failed')
+        results.append(json.loads(process.stdout.decode().strip().splitlines()[-1]))
+
+    report = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    baseline_results = {}
+    if baseline:
+        with open(baseline) as file:
+            baseline_results = {r['scenario']: r for r in json.load(file).get('results', [])}
+
+    for r in results:
+        metrics = []
+        for m in COMPARED_METRICS:
+            b = baseline_results.get(r['scenario'], {}).get(m)
+            if b:
+                metrics.append(f'{m}={r[m]} ({r[m] / b - 1:+.0%})')
+            else:
+                metrics.append(f'{m}={r[m]}')
+        click.echo(f'{r["scenario"]}: {" ".join(metrics)}')
+
+
+if __name__ == '__main__':
+    run(prog_name='python -m benchmark')
@@ -0,0 +1,139 @@
+import subprocess
+import threading
+import os
+
+
+class FakeCli(object):
+    """
+        executes the useradd, usermod, gpasswd and groupadd commands issued by cli._execute against
+        passwd and group files in a temporary root. every command still spawns a (no-op) process,
+        so the spawn overhead is part of the measured time
+    """
+
+    def __init__(self, root, spawn='/bin/true'):
+        """
+        initialize the fake cli backend
+        :param root: temporary root directory, etc/passwd, etc/group and home are created in it
+        :param spawn: executable spawned for every command, None to skip spawning
+        """
+        self.root = root
+        self.spawn = spawn
+        self.passwd_file = os.path.join(root, 'etc', 'passwd')
+        self.group_file = os.path.join(root, 'etc', 'group')
+        self.home = os.path.join(root, 'home')
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.dirty = False
+
+        os.makedirs(os.path.dirname(self.passwd_file), exist_ok=True)
+        os.makedirs(self.home, exist_ok=True)
+
+        # all users share the uid and gid of the benchmark, so ownership changes succeed
+        self.uid = os.getuid()
+        self.gid = os.getgid()
+        self.passwd = {'root': ['root', 'x', '0', '0', 'root', '/root', '/bin/bash']}
+        self.group = {'root': ['root', 'x', '0']}
+        # members per group as ordered dictionary keys, joins stay cheap for large groups
+        self.members = {'root': {}}
+        self.flush()
+
+    @property
+    def spawns(self):
+        return sum(self.commands.values())
+
+    def add_user(self, username, shell='/bin/bash', groups=[]):
+        """
+        add a user without executing a command, used to prepare scenarios
+        """
+
+        with self.lock:
+            self._useradd(username, groups, shell)
+            self.dirty = True
+
+    def add_group(self, name):
+        """
+        add a group without executing a command, used to prepare scenarios
+        """
+
+        with self.lock:
+            self._groupadd(name)
+            self.dirty = True
+
+    def execute(self, cli):
+        """
+        replacement of cli._execute
+        :param cli: command as argument list
+        :return: bytes
+        """
+
+        command = os.path.basename(cli[0])
+        if self.spawn:
+            subprocess.run([self.spawn], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        with self.lock:
+            self.commands[command] = self.commands.get(command, 0) + 1
+            self.dirty = True
+
+            if command == 'groupadd':
+                self._groupadd(cli[-1])
+            elif command == 'useradd':
+                self._useradd(cli[-1], self._option(cli, '-G', '').split(','), self._option(cli, '--shell', '/bin/sh'))
+            elif command == 'usermod':
+                username = cli[-1]
+                if username not in self.passwd:
+                    raise ValueError(f'usermod: user \'{username}\' does not exist\n')
+                if '--shell' in cli:
+                    self.passwd[username][6] = self._option(cli, '--shell')
+                self._join(username, self._option(cli, '-G', '').split(','))
+            elif command == 'gpasswd':
+                self.members[cli[-1]] = dict.fromkeys([m for m in cli[2].split(',') if m])
+
+        return b''
+
+    def flush(self):
+        """
+        write the passwd and group files, called before the account database is loaded
+        :return:
+        """
+
+        with self.lock:
+            groups = [self._group_entry(g) for g in self.group]
+            for path, entries in [(self.passwd_file, self.passwd.values()), (self.group_file, groups)]:
+                with open(path, 'w') as file:
+                    file.write(''.join([':'.join(e) + '\n' for e in entries]))
+            self.dirty = False
+
+    def _groupadd(self, name):
+        if name not in self.group:
+            self.group[name] = [name, 'x', str(1000 + len(self.group))]
+            self.members[name] = {}
+
+    def _group_entry(self, name):
+        if name not in self.group:
+            return None
+        return self.group[name] + [','.join(self.members[name])]
+
+    def _useradd(self, username, groups, shell):
+        if username in self.passwd:
+            raise ValueError(f'useradd: user \'{username}\' already exists\n')
+        home = os.path.join(self.home, username)
+        self.passwd[username] = [username, 'x', str(self.uid), str(self.gid), '', home, shell]
+        # appended right away like useradd does, single users are looked up without a flush
+        with open(self.passwd_file, 'a') as file:
+            file.write(':'.join(self.passwd[username]) + '\n')
+        os.makedirs(home, exist_ok=True)
+        self._join(username, groups)
+
+    def _join(self, username, groups):
+        for g in groups:
+            if not g:
+                continue
+            if g not in self.group:
+                raise ValueError(f'group \'{g}\' does not exist\n')
+            self.members[g][username] = None
+
+    @staticmethod
+    def _option(cli, option, default=None):
+        if option in cli:
+            return cli[cli.index(option) + 1]
+        return default
@@ -0,0 +1,85 @@
+from az import AzureContainer
+import threading
+import datetime
+import bisect
+import time
+
+
+class FakeDownload(object):
+    def __init__(self, content):
+        self.content = content
+
+    def readall(self):
+        return self.content
+
+
+class FakeContainerClient(object):
+    """
+        in-memory stand-in for azure.storage.blob.ContainerClient, implements the
+        listing and download calls used by AzureContainer
+    """
+
+    def __init__(self, blobs, latency=0.0):
+        """
+        initialize the fake container client
+        :param blobs: dictionary of blob names and their content
+        :param latency: seconds each storage request takes
+        """
+        self.blobs = blobs
+        self.latency = latency
+        self.names = sorted(blobs)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.last_modified = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def list_blobs(self, name_starts_with=None):
+        # the storage api returns the blobs sorted by name, up to 5000 blobs per list request
+        start = bisect.bisect_left(self.names, name_starts_with or '')
+        end = bisect.bisect_left(self.names, name_starts_with + '\U0010ffff') if name_starts_with else len(self.names)
+        names = self.names[start:end]
+        pages = max(1, (len(names) + 4999) // 5000)
+        with self.lock:
+            self.requests += pages
+        time.sleep(self.latency * pages)
+        for n in names:
+            yield {'name': n, 'etag': f'"{hash(self.blobs[n]) & 0xffffffff:08x}"', 'last_modified': self.last_modified}
+
+    def download_blob(self, name):
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        return FakeDownload(self.blobs[name].encode())
+
+
+class FakeAzureContainer(AzureContainer):
+    """
+        AzureContainer backed by a FakeContainerClient, the listing, caching and
+        parallel download logic of AzureContainer is used unchanged
+    """
+
+    # the blobs served by all instances, set by the benchmark before the cycle
+    blobs = {}
+    latency = 0.0
+    client_instance = None
+    # errors of the blob listings, the script only logs them but the scenario fails
+    errors = []
+
+    def __init__(self, credentials, storage_account_name, storage_account_container, cache=None, max_concurrency=8):
+        super().__init__(credentials=credentials, storage_account_name=storage_account_name,
+                         storage_account_container=storage_account_container, cache=cache,
+                         max_concurrency=max_concurrency)
+        self._client = FakeContainerClient(blobs=self.blobs, latency=self.latency)
+        FakeAzureContainer.client_instance = self._client
+
+    def get_blobs(self, *args, **kwargs):
+        return self._record(super().get_blobs, *args, **kwargs)
+
+    def get_user_blobs(self, *args, **kwargs):
+        return self._record(super().get_user_blobs, *args, **kwargs)
+
+    def _record(self, listing, *args, **kwargs):
+        try:
+            return listing(*args, **kwargs)
+        except Exception as e:
+            FakeAzureContainer.errors.append(e)
+            raise e
@@ -0,0 +1,207 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+import threading
+import random
+import time
+import json
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer requires python 3.7
+    daemon_threads = True
+
+
+class FakeGraph(object):
+    """
+        local stand-in for the azure graph api. serves paged direct and transitive group members,
+        $batch requests, group and user delta queries and single users of a generated directory,
+        and optionally throttles a fraction of the requests with 429 responses
+    """
+
+    def __init__(self, users, groups, throttle_rate=0.0, seed=0, latency=0.0):
+        """
+        initialize the fake graph api
+        :param users: list of user dictionaries, each with an id
+        :param groups: dictionary of group ids and their member user and nested group ids
+        :param throttle_rate: fraction of the requests answered with 429 too many requests
+        :param seed: seed of the throttling decisions, runs are reproducible
+        :param latency: seconds each request takes
+        """
+        self.users = {u['id']: u for u in users}
+        self.groups = groups
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.server = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}/v1.0'
+
+    def start(self):
+        """
+        start serving on a random local port in a background thread
+        :return:
+        """
+
+        graph = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep the connections open, the clients use pooled sessions
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.respond(*graph.handle('GET', self.path))
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                self.respond(*graph.handle('POST', self.path, body))
+
+            def respond(self, status, headers, body):
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        """
+        stop serving
+        :return:
+        """
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, path, body=None):
+        """
+        handle a single graph request
+        :param method: GET or POST
+        :param path: request path including the query string
+        :param body: json body of POST requests
+        :return: tuple of status, headers and json body
+        """
+
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        if self._throttle():
+            return 429, {'Retry-After': '0'}, {'error': {'code': 'TooManyRequests', 'message': 'throttled'}}
+
+        url = urlsplit(path)
+        route = url.path[len('/v1.0'):] if url.path.startswith('/v1.0') else url.path
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if method == 'POST' and route == '/$batch':
+            return 200, {}, {'responses': [self._batch_response(r) for r in body.get('requests', [])]}
+        if method == 'GET':
+            return self._get(route, query)
+        return 404, {}, {'error': {'code': 'NotFound', 'message': route}}
+
+    def _throttle(self):
+        if not self.throttle_rate:
+            return False
+        with self.lock:
+            throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttled += 1
+        return throttled
+
+    def _batch_response(self, request):
+        # sub requests of a batch are throttled independently, like graph does
+        if self._throttle():
+            return {'id': request['id'], 'status': 429, 'headers': {'Retry-After': '0'},
+                    'body': {'error': {'code': 'TooManyRequests', 'message': 'throttled'}}}
+
+        url = urlsplit(request['url'])
+        status, headers, body = self._get(url.path, {k: v[0] for k, v in parse_qs(url.query).items()})
+        return {'id': request['id'], 'status': status, 'headers': headers, 'body': body}
+
+    def _get(self, route, query):
+        parts = route.strip('/').split('/')
+
+        if len(parts) >= 3 and parts[0] == 'groups' and parts[1] not in self.groups:
+            return 404, {}, {'error': {'code': 'Request_ResourceNotFound', 'message': parts[1]}}
+
+        if len(parts) == 3 and parts[0] == 'groups' and parts[2] == 'members':
+            members = [self.users.get(m) or {'@odata.type': '#microsoft.graph.group', 'id': m}
+                       for m in self.groups[parts[1]]]
+            return self._page(f'/groups/{parts[1]}/members', members, query)
+
+        if parts[:1] == ['groups'] and parts[2:] == ['transitiveMembers', 'microsoft.graph.user']:
+            members = [self.users[u] for u in self._transitive_members(parts[1])]
+            if query.get('$filter') == 'accountEnabled eq true':
+                members = [m for m in members if m.get('accountEnabled')]
+            return self._page(f'/groups/{parts[1]}/transitiveMembers/microsoft.graph.user', members, query)
+
+        if parts == ['groups', 'delta']:
+            return self._groups_delta(query)
+
+        if parts == ['users', 'delta']:
+            if '$deltatoken' in query:
+                return 200, {}, {'value': [], '@odata.deltaLink': f'{self.url}/users/delta?$deltatoken=latest'}
+            return self._page('/users/delta', list(self.users.values()), query, delta=True)
+
+        if len(parts) == 2 and parts[0] == 'users':
+            if parts[1] not in self.users:
+                return 404, {}, {'error': {'code': 'Request_ResourceNotFound', 'message': parts[1]}}
+            return 200, {}, self._select(self.users[parts[1]], query)
+
+        return 404, {}, {'error': {'code': 'NotFound', 'message': route}}
+
+    def _page(self, route, objects, query, delta=False):
+        # paging with $top and an opaque $skiptoken, the next link repeats the query
+        top = int(query.get('$top', 100))
+        skip = int(query.get('$skiptoken', 0))
+
+        page = {'value': [self._select(o, query) for o in objects[skip:skip + top]]}
+        if skip + top < len(objects):
+            next_query = '&'.join([f'{k}={v}' for k, v in query.items() if k != '$skiptoken'])
+            page['@odata.nextLink'] = f'{self.url}{route}?{next_query}&$skiptoken={skip + top}'
+        elif delta:
+            page['@odata.deltaLink'] = f'{self.url}{route}?$deltatoken=latest'
+        return 200, {}, page
+
+    def _groups_delta(self, query):
+        if '$deltatoken' in query:
+            return 200, {}, {'value': [], '@odata.deltaLink': f'{self.url}/groups/delta?$deltatoken=latest'}
+
+        group_ids = [g for g in self.groups if f"id eq '{g}'" in query.get('$filter', '')]
+        value = [
+            {'id': g, 'members@delta': [{'@odata.type': '#microsoft.graph.user', 'id': u} for u in self.groups[g]]}
+            for g in group_ids
+        ]
+        return 200, {}, {'value': value, '@odata.deltaLink': f'{self.url}/groups/delta?$deltatoken=latest'}
+
+    def _transitive_members(self, group_id, visited=None):
+        # user ids of the group and all nested groups, each user only once
+        visited = visited if visited is not None else set()
+        visited.add(group_id)
+        users = {}
+        for m in self.groups.get(group_id, []):
+            if m in self.users:
+                users[m] = None
+            elif m in self.groups and m not in visited:
+                users.update(dict.fromkeys(self._transitive_members(m, visited)))
+        return list(users)
+
+    @staticmethod
+    def _select(user, query):
+        fields = query.get('$select')
+        user = dict({'@odata.type': '#microsoft.graph.user'}, **user)
+        if not fields:
+            return user
+        return {k: v for k, v in user.items() if k in fields.split(',') or k == '@odata.type'}
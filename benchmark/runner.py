@@ -0,0 +1,194 @@
+"""
+    execute a single benchmark scenario in the current process and print the result as json.
+    the scenarios are started as separate processes by the benchmark command, so the peak
+    rss of one scenario isnt influenced by another
+"""
+
+from azure.core.credentials import AccessToken
+from .fakecli import FakeCli
+from .fakecontainer import FakeAzureContainer
+from .fakegraph import FakeGraph
+from .scenarios import get_scenario
+import importlib.util
+import resource
+import tempfile
+import logging
+import shutil
+import json
+import time
+import sys
+import os
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'azure-ad-users-to-linux.py')
+MANAGED_GROUP = 'azure-ad-users-to-linux'
+
+
+class FakeCredential(object):
+    def get_token(self, *scopes, **kwargs):
+        return AccessToken('benchmark', int(time.time()) + 3600)
+
+
+def generate_directory(users, groups, keys, foreign_blobs=0):
+    """
+    generate the azure ad users, group memberships and ssh key blobs of a scenario.
+    the foreign blobs belong to other tenants and tools sharing the container
+    :return: tuple of user list, group dictionary and blob dictionary
+    """
+
+    directory = []
+    members = {f'group-{g}': [] for g in range(groups)}
+    blobs = {}
+    for i in range(users):
+        upn = f'user{i}@benchmark.example.com'
+        directory.append({
+            'id': f'00000000-0000-0000-0000-{i:012d}',
+            'accountEnabled': i % 50 != 49,
+            'displayName': f'User {i}',
+            'mail': upn,
+            'userPrincipalName': upn,
+        })
+        members[f'group-{i % groups}'].append(directory[-1]['id'])
+        if i % 10 == 0 and groups > 1:
+            members[f'group-{(i + 1) % groups}'].append(directory[-1]['id'])
+        for k in range(keys):
+            name = f'{upn}.pub' if k == 0 else f'{upn}.key{k}.pub'
+            blobs[name] = f'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAI{i:020d}{k:04d} {upn}'
+    for i in range(foreign_blobs):
+        blobs[f'tenant-{i % 7}/user{i}@other.example.com.pub'] = f'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAI{i:020d}'
+    return directory, members, blobs
+
+
+def load_script():
+    """
+    load the sync script as module, its file name isnt a valid module name
+    :return: module
+    """
+
+    spec = importlib.util.spec_from_file_location('azure_ad_users_to_linux', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_scenario(name):
+    """
+    execute the given scenario
+    :param name: scenario name
+    :return: result dictionary
+    """
+
+    scenario = get_scenario(name)
+    tmp = tempfile.mkdtemp(prefix='azure-ad-users-to-linux-benchmark-')
+    try:
+        directory, members, blobs = generate_directory(scenario['users'], scenario['groups'], scenario['keys'],
+                                                     scenario['foreign_blobs'])
+
+        graph = FakeGraph(users=directory, groups=members, throttle_rate=scenario['throttle_rate'],
+                          latency=scenario['latency'])
+        graph.start()
+
+        # all account changes are executed against the temporary root
+        fakecli = FakeCli(root=os.path.join(tmp, 'root'))
+        fakecli.add_group(MANAGED_GROUP)
+        fakecli.add_group('docker')
+
+        import cli.cli
+        from users import accountdb
+        cli.cli._execute = fakecli.execute
+        accountdb.passwd_file = fakecli.passwd_file
+        accountdb.group_file = fakecli.group_file
+        refresh = accountdb.refresh
+
+        def flush_and_refresh():
+            if fakecli.dirty:
+                fakecli.flush()
+            refresh()
+        accountdb.refresh = flush_and_refresh
+
+        main = load_script()
+        FakeAzureContainer.blobs = blobs
+        FakeAzureContainer.latency = scenario['latency']
+
+        class BenchmarkCredential(main.CachedCredential):
+            @classmethod
+            def from_client_secret(cls, tenant_id, client_id, client_secret, cache_file=None):
+                return cls(credential=FakeCredential(), cache_file=cache_file)
+
+        class SingleCycleScheduler(main.Scheduler):
+            result = None
+
+            def run(self, cycle):
+                SingleCycleScheduler.result = self.run_once(cycle)
+
+        main.CachedCredential = BenchmarkCredential
+        # the service keeps its container client, and the container size it learned, across the cycles
+        containers = []
+
+        def container(**kwargs):
+            if not containers:
+                containers.append(FakeAzureContainer(**kwargs))
+            return containers[0]
+
+        main.AzureContainer = container
+        main.Scheduler = SingleCycleScheduler
+
+        args = [
+            '--loglevel', 'ERROR',
+            '--tenant-id', 'benchmark',
+            '--client-id', 'benchmark',
+            '--client-secret', 'benchmark',
+            '--azure-ad-graph-url', graph.url,
+            '--storage-account-name', 'benchmark',
+            '--storage-account-container', 'ssh-keys',
+            '--linux-group-name', MANAGED_GROUP,
+            '--additional-linux-groups', 'docker',
+        ]
+        for g in members:
+            args.extend(['--azure-ad-groups', g])
+        args.extend([a.format(tmp=tmp) for a in scenario['args']])
+
+        def cycle():
+            FakeAzureContainer.errors = []
+            main.run.main(args=args, standalone_mode=False)
+            if not SingleCycleScheduler.result:
+                raise ValueError(f'Sync cycle of scenario {name} failed')
+            if FakeAzureContainer.errors:
+                raise ValueError(f'Blob listing of scenario {name} failed: {FakeAzureContainer.errors[0]}')
+
+        if scenario['warm']:
+            cycle()
+            graph.requests = 0
+            graph.throttled = 0
+            fakecli.commands = {}
+            FakeAzureContainer.client_instance.requests = 0
+
+        for i in range(scenario['stale']):
+            fakecli.add_user(f'stale{i}', groups=[MANAGED_GROUP])
+
+        start = time.monotonic()
+        cycle()
+        wall_time = time.monotonic() - start
+
+        storage_requests = FakeAzureContainer.client_instance.requests
+        result = {
+            'scenario': name,
+            'parameters': scenario,
+            'wall_time': round(wall_time, 3),
+            'subprocesses': fakecli.spawns,
+            'subprocesses_by_command': dict(sorted(fakecli.commands.items())),
+            'http_requests': graph.requests + storage_requests,
+            'graph_requests': graph.requests,
+            'graph_throttled': graph.throttled,
+            'storage_requests': storage_requests,
+            # ru_maxrss is reported in KiB on linux
+            'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+        graph.stop()
+        return result
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    print(json.dumps(run_scenario(sys.argv[1])))
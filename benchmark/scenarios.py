@@ -0,0 +1,58 @@
+# benchmark scenarios, a scenario is a single measured sync cycle against a generated directory
+#   users: number of azure ad users, every 50th user is disabled
+#   groups: number of azure ad groups the users are spread across, every 10th user is member of two groups
+#   keys: number of ssh keys per user
+#   foreign_blobs: number of blobs of other tenants and tools in the ssh key container
+#   stale: number of managed local users which arent in azure ad anymore and get disabled in the measured cycle
+#   throttle_rate: fraction of graph requests answered with 429
+#   latency: seconds each graph and storage request takes
+#   warm: execute an unmeasured cycle first, the measured cycle starts from a synced system
+#   args: additional command line options
+SCENARIOS = {
+    'cold-100': {'users': 100},
+    'cold-5k': {'users': 5000},
+    'warm-5k': {'users': 5000, 'warm': True},
+    'warm-cached-5k': {'users': 5000, 'warm': True, 'args': ['--blob-cache-dir', '{tmp}/blob-cache']},
+    'stale-5k': {'users': 5000, 'stale': 500, 'warm': True},
+    'throttled-5k': {'users': 5000, 'throttle_rate': 0.2, 'args': ['--azure-ad-page-size', '100']},
+    'delta-warm-5k': {'users': 5000, 'warm': True, 'args': ['--azure-ad-delta-state-file', '{tmp}/delta.json']},
+    'latency-5k': {'users': 5000, 'latency': 0.01, 'warm': True, 'args': ['--azure-ad-page-size', '100']},
+    'pipeline-cold-5k': {'users': 5000, 'args': ['--pipeline']},
+    'pipeline-latency-5k': {'users': 5000, 'latency': 0.01, 'warm': True,
+                            'args': ['--azure-ad-page-size', '100', '--pipeline']},
+    'pipeline-stale-5k': {'users': 5000, 'stale': 500, 'warm': True, 'args': ['--pipeline']},
+    'shared-container-list-3k': {'users': 3000, 'foreign_blobs': 200000, 'latency': 0.005, 'warm': True,
+                                 'args': ['--blob-lookup-strategy', 'list']},
+    'shared-container-auto-3k': {'users': 3000, 'foreign_blobs': 200000, 'latency': 0.005, 'warm': True},
+    'cold-50k': {'users': 50000},
+    'warm-50k': {'users': 50000, 'warm': True},
+}
+
+# scenarios executed if none are selected, the 50k scenarios take minutes
+DEFAULT_SCENARIOS = ['cold-100', 'cold-5k', 'warm-5k', 'warm-cached-5k', 'stale-5k', 'throttled-5k', 'delta-warm-5k',
+                     'latency-5k', 'pipeline-cold-5k', 'pipeline-stale-5k', 'pipeline-latency-5k',
+                     'shared-container-list-3k', 'shared-container-auto-3k']
+
+DEFAULTS = {
+    'users': 100,
+    'groups': 4,
+    'keys': 1,
+    'foreign_blobs': 0,
+    'stale': 0,
+    'throttle_rate': 0.0,
+    'latency': 0.0,
+    'warm': False,
+    'args': [],
+}
+
+
+def get_scenario(name):
+    """
+    returns the parameters of the given scenario, completed with the defaults
+    :param name: scenario name
+    :return: dictionary
+    """
+
+    if name not in SCENARIOS:
+        raise ValueError(f'Unknown scenario {name}, available scenarios: {", ".join(SCENARIOS)}')
+    return dict(DEFAULTS, **SCENARIOS[name])
@@ -1 +1 @@
-from .cli import Cli
\ No newline at end of file
+from .cli import Cli, CliBatch
\ No newline at end of file
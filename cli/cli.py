@@ -1,11 +1,15 @@
+from metrics import registry
 import subprocess
 import logging
+import os
 
 
 def _execute(cli):
     # rhel / centos 8 uses python3.6, so no capture_output for us
-    #result = subprocess.run(cli, capture_output=True, text=True, shell=True)
-    result = subprocess.run(cli, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+    # the command is given as argument list and executed without a shell
+    #result = subprocess.run(cli, capture_output=True, text=True)
+    with registry.timer('subprocess_duration_seconds', command=os.path.basename(cli[0])):
+        result = subprocess.run(cli, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     if result.stderr:
         raise ValueError(result.stderr)
@@ -17,21 +21,6 @@ class Cli(object):
         execute different cli commands and parse their outputs
     """
 
-    @staticmethod
-    def getent(database, key):
-        """
-        execute getent and return the returned value
-        https://man7.org/linux/man-pages/man1/getent.1.html
-
-        :param database: database to query
-        :param key: key to query for
-        :return: string
-        """
-
-        return _execute(
-            cli=f'/usr/bin/getent {database} {key}'
-        )
-
     @staticmethod
     def groupadd(name):
         """
@@ -42,71 +31,158 @@ class Cli(object):
 
         try:
             _execute(
-                cli=f'/usr/sbin/groupadd --system {name}'
+                cli=['/usr/sbin/groupadd', '--system', name]
             )
         except ValueError as e:
             raise ValueError(f'Unable to create group {name}: {e}')
 
     @staticmethod
-    def useradd(username):
+    def useradd(username, groups=[], shell=None):
         """
         create local linux user
         :param username:
+        :param groups: optional supplementary groups of the user
+        :param shell: optional login shell of the user
         :return:
         """
 
+        cli = ['/usr/sbin/useradd']
+        if groups:
+            cli.extend(['-G', ','.join(groups)])
+        if shell:
+            cli.extend(['--shell', shell])
+        cli.append(username)
+
         try:
             _execute(
-                cli=f'/usr/sbin/useradd {username}'
+                cli=cli
             )
         except ValueError as e:
             raise ValueError(f'Unable to create user {username}: {e}')
 
     @staticmethod
-    def joingroup(username, group):
+    def usermod(username, groups=[], shell=None):
         """
-        join user to group
-        :param username: name of the user to join
-        :param group: name of the group to join
+        join user to multiple groups and optionally set the login shell with a single usermod call
+        :param username: name of the user to modify
+        :param groups: names of the groups to join
+        :param shell: optional login shell
         :return:
         """
 
+        cli = ['/usr/sbin/usermod']
+        if groups:
+            cli.extend(['-a', '-G', ','.join(groups)])
+        if shell:
+            cli.extend(['--shell', shell])
+        cli.append(username)
+
         try:
             _execute(
-                cli=f'/usr/sbin/usermod -a -G {group} {username}'
+                cli=cli
             )
         except ValueError as e:
-            raise ValueError(f'Unable to join user {username} to group {group}: {e}')
+            raise ValueError(f'Unable to modify user {username} (groups: {",".join(groups)}, shell: {shell}): {e}')
 
     @staticmethod
-    def setloginshell(username, shell):
+    def setgroupmembers(group, members):
         """
-        set the login shell of the user
-        :param username:
-        :param shell:
+        set the list of members of the group
+        :param group: name of the group
+        :param members: names of all group members
         :return:
         """
 
         try:
             _execute(
-                cli=f'/usr/sbin/usermod --shell {shell} {username}'
+                cli=['/usr/bin/gpasswd', '-M', ','.join(members), group]
             )
         except ValueError as e:
-            raise ValueError(f'Unable to set login shell of user {username} to {shell}: {e}')
+            raise ValueError(f'Unable to set members of group {group}: {e}')
 
-    @staticmethod
-    def getgroupmembership(username):
+class CliBatch(object):
+    """
+        collect group memberships and login shell changes of multiple users and
+        apply them with as few usermod and gpasswd calls as possible
+    """
+
+    def __init__(self, bulk_threshold=10):
+        """
+        initialize the batch
+        :param bulk_threshold: groups joined by at least this number of users are set with a single gpasswd call
         """
-        return a list of groups the user is member of
+        self.bulk_threshold = bulk_threshold
+        self.groups = {}
+        self.shells = {}
+
+    def joingroup(self, username, group):
+        """
+        join user to group when the batch is applied
+        :param username: name of the user to join
+        :param group: name of the group to join
+        :return:
+        """
+
+        groups = self.groups.setdefault(username, [])
+        if group not in groups:
+            groups.append(group)
+
+    def setloginshell(self, username, shell):
+        """
+        set the login shell of the user when the batch is applied
         :param username:
-        :return: list of group names
+        :param shell:
+        :return:
         """
 
-        try:
-            groups = _execute(
-                cli=f'/usr/bin/id -Gn {username}'
-            )
-        except ValueError as e:
-            raise ValueError(f'Unable to get group memberships of user {username}: {e}')
+        self.shells[username] = shell
+
+    def apply(self, get_group_members):
+        """
+        apply all collected changes. groups joined by many users are set with gpasswd -M,
+        all remaining changes of a user are applied with a single usermod call.
+        failed changes are logged and dont stop the remaining ones
+        :param get_group_members: function returning the current members of a group
+        :return: list of users with failed changes
+        """
 
-        return groups.decode().strip().split(' ')
\ No newline at end of file
+        failed = []
+
+        # collect the joining users of each group
+        joining = {}
+        for username, groups in self.groups.items():
+            for g in groups:
+                joining.setdefault(g, []).append(username)
+
+        bulk = []
+        for g, usernames in joining.items():
+            if len(usernames) < self.bulk_threshold:
+                continue
+            try:
+                members = list(get_group_members(g) or [])
+                logging.info(f'Add users {", ".join(usernames)} to linux group {g}')
+                Cli.setgroupmembers(group=g, members=members + [u for u in usernames if u not in members])
+                bulk.append(g)
+            except Exception as e:
+                # fall back to usermod for the group members
+                logging.warning(e)
+
+        for username in list(self.groups) + [u for u in self.shells if u not in self.groups]:
+            groups = [g for g in self.groups.get(username, []) if g not in bulk]
+            shell = self.shells.get(username)
+            if not groups and not shell:
+                continue
+            try:
+                if groups:
+                    logging.info(f'Add user {username} to linux groups {", ".join(groups)}')
+                if shell:
+                    logging.info(f'Set users {username} login shell to {shell}')
+                Cli.usermod(username=username, groups=groups, shell=shell)
+            except Exception as e:
+                logging.warning(e)
+                failed.append(username)
+
+        self.groups = {}
+        self.shells = {}
+
+        return failed
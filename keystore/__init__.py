@@ -0,0 +1 @@
+from .keystore import KeyStore
\ No newline at end of file
@@ -0,0 +1,139 @@
+from util import keys_hash
+import sqlite3
+import stat
+import os
+
+# the key store is read by the authorized keys command on every ssh login,
+# keep the imports required for lookups to a minimum
+
+
+class KeyStore(object):
+    """
+        local sqlite index of the managed ssh keys keyed by linux username. the sync daemon
+        maintains the index, sshd reads it through the authorized keys command
+    """
+
+    def __init__(self, path):
+        """
+        initialize the key store
+        :param path: path to the sqlite database
+        """
+        self.path = path
+
+    def get(self, username):
+        """
+        returns the ssh keys of the given user
+        :param username: linux username
+        :return: list of ssh keys, empty if the user isnt managed
+        """
+
+        # open the database read only, the lookup never creates or modifies the store
+        connection = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, timeout=5)
+        try:
+            row = connection.execute('SELECT keys FROM keys WHERE username = ?', (username,)).fetchone()
+        finally:
+            connection.close()
+
+        if not row or not row[0]:
+            return []
+        return row[0].split('\n')
+
+    def check_directory(self):
+        """
+        ensure the key store is readable by the unprivileged AuthorizedKeysCommandUser, all directories
+        up to the key store need to be traversable by others. the key store is kept in its own directory,
+        the directory of the other state files is only accessible by root
+        :return:
+        """
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o0755, exist_ok=True)
+            # the mode of makedirs is masked by the umask
+            os.chmod(directory, 0o0755)
+
+        while True:
+            if not os.stat(directory).st_mode & stat.S_IXOTH:
+                raise ValueError(f'The key store {self.path} isnt readable by the AuthorizedKeysCommandUser, '
+                                 f'the directory {directory} isnt accessible by others')
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return
+            directory = parent
+
+    def _connect(self):
+        self.check_directory()
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS keys ('
+            'username TEXT PRIMARY KEY, keys TEXT NOT NULL, keys_hash TEXT NOT NULL, updated_at INTEGER NOT NULL)'
+        )
+        return connection
+
+    def update(self, ssh_keys, keep=[], prune=True):
+        """
+        replace the content of the key store in a single transaction, only changed users are written
+        :param ssh_keys: dictionary of linux usernames and their list of ssh keys
+        :param keep: usernames whose stored keys are kept as they are
+        :param prune: remove all other users, otherwise only the given users are written
+        :return: number of changed users
+        """
+
+        import time
+
+        connection = self._connect()
+        try:
+            with connection:
+                if prune:
+                    current = dict(connection.execute('SELECT username, keys_hash FROM keys'))
+                else:
+                    current = {}
+                    usernames = list(ssh_keys)
+                    # stay below the sqlite limit of query parameters
+                    for i in range(0, len(usernames), 500):
+                        current.update(connection.execute(
+                            f'SELECT username, keys_hash FROM keys WHERE username IN '
+                            f'({",".join(["?"] * len(usernames[i:i + 500]))})', usernames[i:i + 500]
+                        ))
+
+                changed = 0
+                now = int(time.time())
+                for username, keys in ssh_keys.items():
+                    new_hash = keys_hash(keys)
+                    if current.get(username) == new_hash:
+                        continue
+                    connection.execute(
+                        'INSERT OR REPLACE INTO keys (username, keys, keys_hash, updated_at) VALUES (?, ?, ?, ?)',
+                        (username, '\n'.join(keys), new_hash, now)
+                    )
+                    changed += 1
+
+                for username in current:
+                    if username in ssh_keys or username in keep:
+                        continue
+                    connection.execute('DELETE FROM keys WHERE username = ?', (username,))
+                    changed += 1
+        finally:
+            connection.close()
+
+        # the keys are public, sshd runs the authorized keys command as an unprivileged user
+        os.chmod(self.path, 0o0644)
+        return changed
+
+    def prune(self, usernames):
+        """
+        remove all users except the given ones, completes the updates of a chunked sync
+        :param usernames: usernames whose stored keys are kept
+        :return: number of removed users
+        """
+
+        connection = self._connect()
+        try:
+            with connection:
+                removed = [(u,) for (u,) in connection.execute('SELECT username FROM keys') if u not in usernames]
+                connection.executemany('DELETE FROM keys WHERE username = ?', removed)
+        finally:
+            connection.close()
+
+        os.chmod(self.path, 0o0644)
+        return len(removed)
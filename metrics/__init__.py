@@ -0,0 +1,2 @@
+from .registry import Registry, Timer, registry
+from .server import MetricsServer
\ No newline at end of file
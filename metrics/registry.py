@@ -0,0 +1,175 @@
+from util import atomic_write
+import threading
+import time
+
+
+def _escape(value):
+    # escape label values as required by the prometheus text format
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Timer(object):
+    """
+        context manager observing the duration of the enclosed block
+    """
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name, time.monotonic() - self.start, **self.labels)
+
+
+class Registry(object):
+    """
+        in-process registry of counters, gauges and timers, rendered in the prometheus text format.
+        updating a metric is a dictionary update under a lock, cheap enough for the hot paths
+    """
+
+    def __init__(self, prefix='azure_ad_users_to_linux'):
+        """
+        initialize the registry
+        :param prefix: prefix of all metric names
+        """
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.types = {}
+        self.descriptions = {}
+
+    def describe(self, name, description):
+        """
+        set the help text of a metric
+        :param name: metric name without prefix
+        :param description: help text
+        :return:
+        """
+
+        self.descriptions[name] = description
+
+    def inc(self, name, value=1, **labels):
+        """
+        increase a counter
+        :param name: metric name without prefix, should end with _total
+        :param value: value to add
+        :param labels: metric labels
+        :return:
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types.setdefault(name, 'counter')
+            self.metrics[key] = self.metrics.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        set a gauge
+        :param name: metric name without prefix
+        :param value: current value
+        :param labels: metric labels
+        :return:
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.types.setdefault(name, 'gauge')
+            self.metrics[key] = value
+
+    def observe(self, name, seconds, **labels):
+        """
+        observe a duration, exported as summary with count and sum
+        :param name: metric name without prefix, should end with _seconds
+        :param seconds: observed duration
+        :param labels: metric labels
+        :return:
+        """
+
+        count = (f'{name}_count', tuple(sorted(labels.items())))
+        total = (f'{name}_sum', tuple(sorted(labels.items())))
+        with self.lock:
+            self.types.setdefault(name, 'summary')
+            self.metrics[count] = self.metrics.get(count, 0) + 1
+            self.metrics[total] = self.metrics.get(total, 0) + seconds
+
+    def timer(self, name, **labels):
+        """
+        returns a context manager observing the duration of the enclosed block
+        :param name: metric name without prefix, should end with _seconds
+        :param labels: metric labels
+        :return: Timer
+        """
+
+        return Timer(registry=self, name=name, labels=labels)
+
+    def render(self):
+        """
+        render all metrics in the prometheus text format
+        :return: string
+        """
+
+        with self.lock:
+            metrics = list(self.metrics.items())
+            types = dict(self.types)
+
+        # the samples of a metric family must be grouped, the _count and _sum samples of
+        # summaries belong to the family without the suffix
+        samples = []
+        for (name, labels), value in metrics:
+            family = name if name in types else name.rsplit('_', 1)[0]
+            samples.append((family, name, labels, value))
+
+        lines = []
+        described = set()
+        for family, name, labels, value in sorted(samples):
+            if family not in described:
+                described.add(family)
+                if family in self.descriptions:
+                    lines.append(f'# HELP {self.prefix}_{family} {self.descriptions[family]}')
+                lines.append(f'# TYPE {self.prefix}_{family} {types.get(family, "untyped")}')
+
+            label = ','.join([f'{k}="{_escape(v)}"' for k, v in labels])
+            lines.append(f'{self.prefix}_{name}{{{label}}} {value}' if label else f'{self.prefix}_{name} {value}')
+
+        return ''.join([f'{l}\n' for l in lines])
+
+    def write_textfile(self, path):
+        """
+        atomically write all metrics to the given file, e.g. for the node exporter textfile collector
+        :param path: path of the .prom file
+        :return:
+        """
+
+        atomic_write(path, self.render(), mode=0o0644)
+
+
+# process wide registry, updated by all instrumented modules
+registry = Registry()
+
+# help texts of the exported metrics
+for name, description in [
+    ('authorized_keys_reads_total', 'Authorized keys files read'),
+    ('authorized_keys_writes_total', 'Authorized keys files written'),
+    ('blob_downloads_total', 'Ssh key blobs returned by source, cache or storage'),
+    ('blob_lookups_total', 'Blob lookups by strategy, list counts full listings and prefix counts listed users'),
+    ('blobs_listed', 'Ssh key blobs found by the last full container listing'),
+    ('graph_batch_retries_total', 'Retried requests of graph batches by status'),
+    ('http_request_duration_seconds', 'Duration of http requests by host'),
+    ('http_requests_total', 'Http requests by host, method and status'),
+    ('http_response_bytes_total', 'Received response bytes by client'),
+    ('last_success_timestamp_seconds', 'Unix timestamp of the last successful sync'),
+    ('subprocess_duration_seconds', 'Duration of spawned processes by command'),
+    ('sync_duration_seconds', 'Duration of the sync cycles'),
+    ('sync_phase_duration_seconds', 'Duration of the phases of the sync cycles'),
+    ('syncs_total', 'Sync cycles by result'),
+    ('token_acquire_duration_seconds', 'Duration of acquiring new access tokens'),
+    ('token_requests_total', 'Access token requests by source, cache or azure'),
+    ('users_total', 'Users by result, created, changed, disabled or failed'),
+]:
+    registry.describe(name, description)
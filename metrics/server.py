@@ -0,0 +1,64 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import threading
+import logging
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer requires python 3.7
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """
+        serve the metrics of a registry on http://address:port/metrics in a background thread
+    """
+
+    def __init__(self, registry, port, address='127.0.0.1'):
+        """
+        initialize the metrics server
+        :param registry: Registry to serve
+        :param port: port to listen on
+        :param address: address to listen on
+        """
+        self.registry = registry
+        self.port = port
+        self.address = address
+        self.server = None
+
+    def start(self):
+        """
+        start serving the metrics
+        :return:
+        """
+
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                content = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                logging.debug(f'Metrics request from {self.address_string()}: {format % args}')
+
+        self.server = _ThreadingHTTPServer((self.address, self.port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logging.info(f'Serve metrics on http://{self.address}:{self.server.server_port}/metrics')
+
+    def stop(self):
+        """
+        stop serving the metrics
+        :return:
+        """
+
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
@@ -0,0 +1,5 @@
+from .pipeline import Pipeline
+from .planner import Change, Planner
+from .scheduler import CycleTimeout, Deadline, Scheduler, TransientError, is_transient
+from .snapshot import SnapshotPublisher, SnapshotSource, decode_snapshot, encode_snapshot
+from .state import StateStore
\ No newline at end of file
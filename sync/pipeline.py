@@ -0,0 +1,405 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from metrics import registry
+from users import AdUser, LinuxUser, ssh_key_owners
+from .scheduler import Deadline
+import threading
+import asyncio
+import logging
+
+# marks the end of the output of a stage
+_DONE = object()
+# number of retrieved users handed from the graph fetch to the download stage at once
+FETCH_BATCH_SIZE = 100
+
+
+class PipelineStopped(Exception):
+    """
+        raised in the producing threads once the pipeline stopped
+    """
+    pass
+
+
+class Pipeline(object):
+    """
+        streaming sync cycle. the graph fetch and the blob listing run at the same time, the ssh keys
+        of a user are downloaded as soon as the user is retrieved and users with all ssh keys downloaded
+        are planned and applied right away. the stages are connected with bounded queues, the blocking
+        azure clients and the local changes run in thread pools. users which arent desired anymore are
+        only disabled once all stages completed successfully. applied users are released, only their
+        usernames are kept, so the memory doesnt grow with the size of the groups
+    """
+
+    def __init__(self, get_members, get_blobs, download_blob, planner, username_field,
+                 ssh_keys_prefix, ssh_keys_suffix, max_concurrent_downloads=8, queue_size=1000, chunk_size=100,
+                 linger=0.1, get_user_blobs=None, on_applied=None, deadline=None):
+        """
+        initialize the pipeline
+        :param get_members: function returning an iterable of (group id, azure user dictionary) tuples
+        :param get_blobs: function returning the ssh key blobs, see AzureContainer.get_blobs
+        :param download_blob: function downloading a blob by name and version, see AzureContainer.download_blob
+        :param planner: Planner computing and applying the changes of the local system
+        :param username_field: field of the azure user the linux username is created from
+        :param ssh_keys_prefix: prefix for ssh key files in the storage account
+        :param ssh_keys_suffix: suffix for ssh key files in the storage account
+        :param max_concurrent_downloads: number of users whose ssh keys are downloaded at the same time
+        :param queue_size: maximum number of users waiting between two stages
+        :param chunk_size: maximum number of users planned and applied at once
+        :param linger: seconds the apply stage waits for further ready users before a chunk is applied
+        :param get_user_blobs: optional function returning the ssh key blobs of a single user principal name,
+                               if set the blobs of each user are looked up instead of listing all blobs
+        :param on_applied: optional function called with the linux users of each applied chunk
+        :param deadline: optional Deadline of the sync cycle, the pipeline stops once it passed
+        """
+        self.get_members = get_members
+        self.get_blobs = get_blobs
+        self.get_user_blobs = get_user_blobs
+        self.download_blob = download_blob
+        self.planner = planner
+        self.username_field = username_field
+        self.ssh_keys_prefix = ssh_keys_prefix
+        self.ssh_keys_suffix = ssh_keys_suffix
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self.linger = linger
+        self.on_applied = on_applied
+        self.deadline = deadline or Deadline()
+
+        self.loop = None
+        self.stopped = threading.Event()
+        self.usernames = set()
+        self.user_principal_names = set()
+        self.members_complete = None
+        self.changes = []
+        self.failed = []
+        self.downloads = set()
+
+    def run(self, apply=True):
+        """
+        execute a single sync cycle
+        :param apply: apply the planned changes, otherwise the changes are only planned
+        :return: tuple of the desired linux usernames, the planned changes (only kept if they arent applied)
+                 and the usernames with failed changes
+        """
+
+        self.loop = asyncio.new_event_loop()
+        self.stopped.clear()
+        self.usernames = set()
+        self.user_principal_names = set()
+        self.members_complete = None
+        self.changes = []
+        self.failed = []
+        self.downloads = set()
+
+        # the downloads run in the default executor, the graph fetch, the blob listing and
+        # the local changes each in a dedicated thread and never wait for a free download worker
+        downloads = ThreadPoolExecutor(max_workers=self.max_concurrent_downloads)
+        stages = ThreadPoolExecutor(max_workers=3)
+        self.loop.set_default_executor(downloads)
+        try:
+            self.loop.run_until_complete(self._run(stages=stages, apply=apply))
+        finally:
+            self.stopped.set()
+            stages.shutdown(wait=True)
+            downloads.shutdown(wait=True)
+            self.loop.close()
+
+        return self.usernames, self.changes, self.failed
+
+    async def _run(self, stages, apply):
+        members = asyncio.Queue(maxsize=max(1, self.queue_size // FETCH_BATCH_SIZE))
+        # set once all members are retrieved, the owners of all ssh keys are known afterwards
+        self.members_complete = asyncio.Event()
+        ready = asyncio.Queue(maxsize=self.queue_size)
+
+        # without a per user lookup all blobs are listed at the same time as the users are retrieved
+        ssh_keys_index = None
+        if not self.get_user_blobs:
+            ssh_keys_index = self.loop.run_in_executor(stages, self._list_blobs)
+        tasks = [
+            self.loop.run_in_executor(stages, self._fetch, members),
+            asyncio.ensure_future(self._download(members, ready, ssh_keys_index)),
+            asyncio.ensure_future(self._apply(ready, stages, apply)),
+        ]
+        if ssh_keys_index:
+            tasks.append(ssh_keys_index)
+
+        # a failed stage stops the whole pipeline, no users are disabled
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        pending = pending | set([d for d in self.downloads if not d.done()])
+        for t in pending:
+            t.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        for t in done:
+            if t.exception():
+                self.stopped.set()
+                raise t.exception()
+
+    def _put_threadsafe(self, queue, item):
+        # blocks the producing thread while the queue is full, until the pipeline stopped
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), self.loop)
+        while True:
+            try:
+                return future.result(timeout=1)
+            except TimeoutError:
+                if self.stopped.is_set():
+                    future.cancel()
+                    raise PipelineStopped('Pipeline stopped')
+
+    def _fetch(self, members):
+        """
+        stream the group members retrieved from azure into the members queue. the members are handed
+        over in batches, as passing each member between the threads costs more than processing it
+        :param members: queue of AdUser batches
+        :return:
+        """
+
+        with registry.timer('sync_phase_duration_seconds', phase='graph_fetch'):
+            batch = []
+            for g, m in self.get_members():
+                # only the fields used by the sync are kept
+                batch.append(AdUser(source_groups=[g], username_field=self.username_field, **m))
+                if len(batch) >= FETCH_BATCH_SIZE:
+                    self.deadline.check()
+                    self._put_threadsafe(members, batch)
+                    batch = []
+            if batch:
+                self._put_threadsafe(members, batch)
+        self._put_threadsafe(members, _DONE)
+
+    def _list_blobs(self):
+        """
+        list the ssh key blobs. the members arent known yet, a blob is indexed for every
+        user principal name it could belong to and assigned to its owner once the user is downloaded
+        :return: ssh key blobs indexed by user principal name
+        """
+
+        with registry.timer('sync_phase_duration_seconds', phase='blob_list'):
+            blobs = []
+            try:
+                blobs = self.get_blobs()
+            except Exception as e:
+                logging.warning(e)
+
+        index = {}
+        for b in blobs:
+            for upn in ssh_key_owners(b.get('name', ''), ssh_keys_prefix=self.ssh_keys_prefix,
+                                      ssh_keys_suffix=self.ssh_keys_suffix):
+                index.setdefault(upn, []).append(b)
+        return index
+
+    async def _download(self, members, ready, ssh_keys_index):
+        """
+        create the linux users of the retrieved group members and download their ssh keys
+        :param members: queue of AdUser batches
+        :param ready: queue of linux users with all ssh keys downloaded
+        :param ssh_keys_index: future of the ssh key blobs indexed by user principal name, none if the
+                               blobs are looked up per user
+        :return:
+        """
+
+        seen = set()
+        slots = asyncio.Semaphore(self.max_concurrent_downloads)
+
+        with registry.timer('sync_phase_duration_seconds', phase='key_download'):
+            while True:
+                batch = await members.get()
+                if batch is _DONE:
+                    self.members_complete.set()
+                    break
+                self.deadline.check()
+
+                for aduser in batch:
+                    # users retrieved from several groups are only synced once
+                    if aduser.id in seen:
+                        continue
+                    seen.add(aduser.id)
+                    self.user_principal_names.add(aduser.userPrincipalName)
+
+                    # set linux user object with a hopefully valid linux username ;-)
+                    try:
+                        lu = LinuxUser(username=aduser.get_linux_username(username_field=self.username_field))
+                    except Exception as e:
+                        logging.warning(f'Unable to create linux user object: {e}')
+                        continue
+                    lu.user_principal_name = aduser.userPrincipalName
+                    lu.object_id = aduser.id
+                    self.usernames.add(lu.username)
+
+                    # the ssh keys are looked up once the blob listing completed
+                    keys = None
+                    if ssh_keys_index:
+                        keys = aduser.get_ssh_keys(ssh_keys_index=await ssh_keys_index)
+
+                    # at most max_concurrent_downloads users are downloaded at the same time
+                    await slots.acquire()
+                    # finished downloads are released right away
+                    download = asyncio.ensure_future(self._download_keys(lu, keys, slots, ready))
+                    self.downloads.add(download)
+                    download.add_done_callback(self.downloads.discard)
+
+            if self.downloads:
+                await asyncio.gather(*list(self.downloads))
+        await ready.put(_DONE)
+
+    async def _download_keys(self, linux_user, keys, slots, ready):
+        """
+        download the ssh keys of a single user and pass the user on to the apply stage
+        :param linux_user: LinuxUser
+        :param keys: list of ssh key blobs of the user, none if the blobs are looked up per user
+        :param slots: semaphore limiting the concurrent downloads, released once the keys are downloaded
+        :param ready: queue of linux users with all ssh keys downloaded
+        :return:
+        """
+
+        holding = True
+        try:
+            if keys is None:
+                keys = await self._lookup_keys(linux_user)
+            if not self.members_complete.is_set() and self._has_unknown_owner(linux_user.user_principal_name, keys):
+                # the owner of a key is only known once all members are retrieved, the download
+                # slot is released meanwhile so the remaining members are processed
+                slots.release()
+                holding = False
+                await self.members_complete.wait()
+                await slots.acquire()
+                holding = True
+            keys = self._get_owned_keys(linux_user.user_principal_name, keys)
+            if not keys and linux_user.manage_ssh_keys:
+                logging.warning(f'No public ssh keys found for {linux_user.user_principal_name}')
+            contents = await asyncio.gather(
+                *[self.loop.run_in_executor(None, self.download_blob, k.get('name'), k.get('etag')) for k in keys],
+                return_exceptions=True
+            )
+        finally:
+            if holding:
+                slots.release()
+
+        for k, c in zip(keys, contents):
+            if isinstance(c, Exception):
+                linux_user.manage_ssh_keys = False
+                logging.warning(f'Unable to download ssh pub key {k}: {c}')
+            else:
+                linux_user.ssh_keys.append(c)
+
+        await ready.put(linux_user)
+
+    async def _lookup_keys(self, linux_user):
+        """
+        look up the ssh key blobs starting with the user principal name of a single user
+        :param linux_user: LinuxUser
+        :return: list of ssh key blobs, not yet assigned to their owners
+        """
+
+        upn = linux_user.user_principal_name
+        if not upn:
+            raise ValueError('No userPrinicipalName set. unable to create ssh key name for user')
+
+        try:
+            blobs = await self.loop.run_in_executor(None, self.get_user_blobs, upn)
+        except Exception as e:
+            # the keys of the user are kept as they are
+            linux_user.manage_ssh_keys = False
+            logging.warning(f'Unable to look up ssh pub keys of {upn}: {e}')
+            return []
+
+        return blobs
+
+    def _get_longer_owners(self, user_principal_name, blob):
+        # the user principal names the blob could belong to, which take precedence over the given one
+        owners = ssh_key_owners(blob.get('name', ''), ssh_keys_prefix=self.ssh_keys_prefix,
+                                ssh_keys_suffix=self.ssh_keys_suffix)
+        if user_principal_name not in owners:
+            return None
+        return owners[:owners.index(user_principal_name)]
+
+    def _has_unknown_owner(self, user_principal_name, keys):
+        """
+        returns true if any of the given blobs could belong to a user which wasnt retrieved yet
+        :param user_principal_name:
+        :param keys: list of ssh key blobs
+        :return:
+        """
+
+        for k in keys:
+            owners = self._get_longer_owners(user_principal_name, k)
+            if owners and not any([o in self.user_principal_names for o in owners]):
+                return True
+        return False
+
+    def _get_owned_keys(self, user_principal_name, keys):
+        """
+        returns the blobs which belong to the given user, blobs matching the user principal name of
+        another retrieved user more exactly belong to that user
+        :param user_principal_name:
+        :param keys: list of ssh key blobs
+        :return: list of ssh key blobs
+        """
+
+        owned = []
+        for k in keys:
+            owners = self._get_longer_owners(user_principal_name, k)
+            if owners is not None and not any([o in self.user_principal_names for o in owners]):
+                owned.append(k)
+        return owned
+
+    async def _apply(self, ready, stages, apply):
+        """
+        plan and apply the ready users in chunks, the users not desired anymore are disabled at the end
+        :param ready: queue of linux users with all ssh keys downloaded
+        :param stages: executor running the local changes
+        :param apply: apply the planned changes, otherwise the changes are only planned
+        :return:
+        """
+
+        first = True
+        done = False
+        while not done:
+            # wait for the first ready user, then collect further users until the chunk is full
+            # or the linger time elapsed. applying single users costs more than applying chunks
+            chunk = [await ready.get()]
+            deadline = self.loop.time() + self.linger
+            while len(chunk) < self.chunk_size and chunk[-1] is not _DONE:
+                if not ready.empty():
+                    chunk.append(ready.get_nowait())
+                    continue
+                if self.loop.time() >= deadline:
+                    break
+                # polls instead of asyncio.wait_for, which can swallow the cancellation of the pipeline
+                await asyncio.sleep(min(0.01, deadline - self.loop.time()))
+            done = chunk[-1] is _DONE
+            linux_users = [u for u in chunk if u is not _DONE]
+
+            if linux_users or first:
+                await self.loop.run_in_executor(stages, self._apply_chunk, linux_users, first, apply)
+                first = False
+
+        await self.loop.run_in_executor(stages, self._apply_disable, self.usernames, apply)
+
+    def _apply_chunk(self, linux_users, first, apply):
+        with registry.timer('sync_phase_duration_seconds', phase='plan'):
+            # ensure the managed group exists before the first users are created
+            changes = self.planner.plan_group() if first else []
+            changes.extend(self.planner.plan_users(linux_users=linux_users))
+
+        if not apply:
+            self.changes.extend(changes)
+            return
+
+        with registry.timer('sync_phase_duration_seconds', phase='apply'):
+            self.failed.extend(self.planner.apply(changes=changes))
+        if self.on_applied:
+            self.on_applied(linux_users)
+
+    def _apply_disable(self, usernames, apply):
+        with registry.timer('sync_phase_duration_seconds', phase='disable'):
+            changes = self.planner.plan_disable(usernames=usernames)
+
+        if not apply:
+            self.changes.extend(changes)
+        else:
+            if changes:
+                with registry.timer('sync_phase_duration_seconds', phase='apply'):
+                    self.failed.extend(self.planner.apply(changes=changes))
+            self.planner.prune(usernames=usernames)
@@ -0,0 +1,338 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from cli import CliBatch
+from metrics import registry
+from users import accountdb as default_accountdb, LinuxGroup, LinuxUser
+from util import keys_hash
+from .scheduler import Deadline
+import threading
+import logging
+import os
+
+# typed change of the local system, the value depends on the action
+Change = namedtuple('Change', ['action', 'username', 'value'])
+
+# create the managed linux group, value is the group name
+CREATE_GROUP = 'create-group'
+# create the linux user, value is a dictionary with the groups and the login shell
+CREATE = 'create'
+# join the user to a group, value is the group name
+ADD_TO_GROUP = 'add-to-group'
+# set the login shell of the user, value is the login shell
+SET_SHELL = 'set-shell'
+# rewrite the authorized keys file of the user, value is the list of ssh keys
+REWRITE_KEYS = 'rewrite-keys'
+# disable the user by setting the disabled login shell, value is the login shell
+DISABLE = 'disable'
+
+
+class Planner(object):
+    """
+        reconcile the desired state retrieved from azure with the observed state of the
+        local system. the planner computes the changes required to get from the observed to
+        the desired state, and only these changes are applied
+    """
+
+    def __init__(self, managed_group, additional_groups=[],
+                 login_shell='/bin/bash', disabled_shell='/sbin/nologin', accountdb=None,
+                 authorized_keys_index=None, manage_authorized_keys=True, state=None, workers=4, deadline=None):
+        """
+        initialize the planner
+        :param managed_group: linux group identifying the managed users
+        :param additional_groups: additional linux groups the managed users are joined to
+        :param login_shell: login shell of enabled users
+        :param disabled_shell: login shell of disabled users
+        :param accountdb: account database snapshot used to observe the local system
+        :param authorized_keys_index: optional AuthorizedKeysIndex to skip reading unchanged authorized keys files
+        :param manage_authorized_keys: write the ssh keys to the authorized keys files in the home directories,
+                                       otherwise the previously written keys are removed from the files
+        :param state: optional StateStore, users recorded as in sync dont need their authorized keys files read
+        :param workers: number of users planned and applied in parallel
+        :param deadline: optional Deadline of the sync cycle, the remaining users are skipped once it passed
+        """
+        self.managed_group = managed_group
+        self.additional_groups = list(additional_groups)
+        self.login_shell = login_shell
+        self.disabled_shell = disabled_shell
+        self.accountdb = accountdb or default_accountdb
+        self.authorized_keys_index = authorized_keys_index
+        self.manage_authorized_keys = manage_authorized_keys
+        self.state = state
+        self.workers = workers
+        self.deadline = deadline or Deadline()
+        # desired state of the planned users, recorded in the state store once applied
+        self.records = {}
+        # users which couldnt be planned, reported as failed by the next apply
+        self.failed = set()
+        self.lock = threading.Lock()
+
+    def plan_group(self):
+        """
+        plan the creation of the managed linux group
+        :return: list of changes
+        """
+
+        if LinuxGroup(name=self.managed_group, accountdb=self.accountdb).exists():
+            return []
+        return [Change(CREATE_GROUP, None, self.managed_group)]
+
+    def plan_user(self, linux_user):
+        """
+        plan the changes of a single desired linux user
+        :param linux_user: LinuxUser with the ssh keys retrieved from azure
+        :return: list of changes
+        """
+
+        changes = []
+        groups = [self.managed_group] + [g for g in self.additional_groups if g != self.managed_group]
+        existing_groups = [g for g in groups if g == self.managed_group or self.accountdb.group(g)]
+
+        # the state is only recorded for users whose ssh keys are complete
+        record = None
+        if linux_user.manage_ssh_keys:
+            record = {
+                'upn': linux_user.user_principal_name,
+                'object_id': linux_user.object_id,
+                'keys_hash': keys_hash(linux_user.ssh_keys),
+                'groups': existing_groups,
+                'shell': self.login_shell,
+            }
+
+        if not linux_user.exists():
+            changes.append(Change(CREATE, linux_user.username, {'groups': existing_groups, 'shell': self.login_shell}))
+            if self.manage_authorized_keys and linux_user.manage_ssh_keys and linux_user.ssh_keys:
+                changes.append(Change(REWRITE_KEYS, linux_user.username, list(linux_user.ssh_keys)))
+            self._add_record(linux_user.username, record)
+            return changes
+
+        # existing users which arent member in the managed group arent touched
+        current_groups = linux_user.get_groups()
+        if self.managed_group not in current_groups:
+            raise ValueError(f'User {linux_user.username} already exists but not member in {self.managed_group}')
+
+        for g in groups:
+            if g in current_groups:
+                continue
+            if not self.accountdb.group(g):
+                logging.warning(f'Unable to join user {linux_user.username} to group {g}: group does not exist')
+                continue
+            changes.append(Change(ADD_TO_GROUP, linux_user.username, g))
+
+        # only change shell if its set to the disabled shell
+        if linux_user.get_login_shell() == self.disabled_shell:
+            changes.append(Change(SET_SHELL, linux_user.username, self.login_shell))
+
+        # the authorized keys files of users recorded as in sync arent read
+        in_sync = not changes and record and self.state and self.state.is_current(linux_user.username, record)
+
+        # with a key store the ssh keys arent written to the home directories
+        if self.manage_authorized_keys:
+            if not linux_user.manage_ssh_keys:
+                logging.warning(f'Unable to manage ssh keys for user {linux_user.username}')
+            elif in_sync and self._authorized_keys_current(linux_user):
+                logging.debug(f'User {linux_user.username} is in sync')
+            elif linux_user.authorized_keys_changed(index=self.authorized_keys_index):
+                changes.append(Change(REWRITE_KEYS, linux_user.username, list(linux_user.ssh_keys)))
+        # the keys written before the files were unmanaged are removed, otherwise sshd keeps accepting
+        # revoked keys from the authorized keys files. the other lines of the files are kept
+        elif LinuxUser(username=linux_user.username, accountdb=self.accountdb).authorized_keys_changed(
+                index=self.authorized_keys_index):
+            changes.append(Change(REWRITE_KEYS, linux_user.username, []))
+
+        # all checks passed, the record is committed once the changes are applied
+        self._add_record(linux_user.username, record)
+        return changes
+
+    def _add_record(self, username, record):
+        if record:
+            with self.lock:
+                self.records[username] = record
+
+    def _authorized_keys_current(self, linux_user):
+        """
+        returns true if the authorized keys file of a user recorded as in sync still exists unchanged,
+        a deleted or recreated home directory is rewritten without waiting for a change of the ssh keys
+        :param linux_user: LinuxUser with the ssh keys retrieved from azure
+        :return:
+        """
+
+        authorized_keys = linux_user.get_authorized_keys_path()
+        if self.authorized_keys_index:
+            return self.authorized_keys_index.is_current(linux_user.username, authorized_keys, linux_user.ssh_keys)
+        # without the index only the existence of the file is checked
+        return not linux_user.ssh_keys or os.path.lexists(authorized_keys)
+
+    def plan_disable(self, usernames):
+        """
+        plan disabling all managed users which arent desired anymore
+        :param usernames: set of desired linux usernames
+        :return: list of changes
+        """
+
+        changes = []
+        for username in LinuxGroup(name=self.managed_group, accountdb=self.accountdb).get_members() or []:
+            if username in usernames:
+                continue
+            if LinuxUser(username=username, accountdb=self.accountdb).get_login_shell() != self.disabled_shell:
+                changes.append(Change(DISABLE, username, self.disabled_shell))
+        return changes
+
+    def prune(self, usernames):
+        """
+        remove the journaled changes of all users which arent desired anymore from the state store,
+        the users which are still managed are planned again by the next sync
+        :param usernames: set of desired linux usernames
+        :return:
+        """
+
+        if self.state:
+            self.state.prune(usernames=usernames)
+
+    def plan_users(self, linux_users):
+        """
+        plan the changes of all desired linux users. the users are planned in parallel,
+        as reading the authorized keys files is mostly waiting for i/o
+        :param linux_users: list of LinuxUser with the ssh keys retrieved from azure
+        :return: list of changes
+        """
+
+        def plan(linux_user):
+            if self.deadline.expired():
+                return []
+            try:
+                return self.plan_user(linux_user=linux_user)
+            except Exception as e:
+                logging.warning(f'Unable to manage user {linux_user.username}: {e}')
+                with self.lock:
+                    self.failed.add(linux_user.username)
+                return []
+
+        changes = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for user_changes in executor.map(plan, linux_users):
+                changes.extend(user_changes)
+        self.deadline.check()
+        return changes
+
+    def apply(self, changes):
+        """
+        apply the given changes, failed changes of a user are logged and dont stop the remaining users.
+        all writes to the passwd and group databases (useradd, usermod, gpasswd) are serialized through
+        a single writer, the authorized keys files are written in parallel once all users are created
+        :param changes: list of changes
+        :return: list of usernames with failed changes, including the users which couldnt be planned
+        """
+
+        with self.lock:
+            failed, self.failed = list(self.failed), set()
+        batch = CliBatch()
+        creates = []
+        rewrites = {}
+
+        # journal the changes, so the users are reconciled again if the apply is interrupted
+        if self.state:
+            self.state.begin(changes=changes)
+
+        for c in changes:
+            if c.action == CREATE_GROUP:
+                LinuxGroup(name=c.value, accountdb=self.accountdb).create()
+            elif c.action == CREATE:
+                creates.append(c)
+            elif c.action == REWRITE_KEYS:
+                rewrites[c.username] = c.value
+            elif c.action == ADD_TO_GROUP:
+                batch.joingroup(username=c.username, group=c.value)
+            elif c.action == SET_SHELL:
+                batch.setloginshell(username=c.username, shell=c.value)
+            elif c.action == DISABLE:
+                logging.warning(f'Disabling user {c.username}')
+                batch.setloginshell(username=c.username, shell=c.value)
+
+        # single worker executing all passwd and group database writes in order
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            # apply the collected group memberships and login shells
+            batch_result = writer.submit(
+                batch.apply,
+                get_group_members=lambda g: LinuxGroup(name=g, accountdb=self.accountdb).get_members()
+            )
+
+            # all users are created before any authorized keys file is written, each created user
+            # is added to the snapshot on its own and the snapshot isnt reloaded in between
+            create_results = [writer.submit(self._create_user, c) for c in creates]
+            failed_creates = set([r.result() for r in create_results]) - set([None])
+            failed.extend(failed_creates)
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = executor.map(lambda u: self._rewrite_keys(u, rewrites[u]),
+                                       [u for u in rewrites if u not in failed_creates])
+                failed.extend([u for u in results if u])
+
+            failed.extend(batch_result.result())
+            # the snapshot is only reloaded if existing users or groups were modified
+            if [c for c in changes if c.action not in [CREATE, REWRITE_KEYS]]:
+                self.accountdb.invalidate()
+
+        # the index is only written if an entry changed
+        if self.authorized_keys_index:
+            self.authorized_keys_index.save()
+
+        # count the users per result, users with failed changes arent counted as changed
+        created = set([c.username for c in changes if c.action == CREATE])
+        disabled = set([c.username for c in changes if c.action == DISABLE])
+        changed = set([c.username for c in changes if c.username]) - created - disabled
+        for result, usernames in [('created', created), ('changed', changed), ('disabled', disabled)]:
+            registry.inc('users_total', len(usernames - set(failed)), result=result)
+        registry.inc('users_total', len(set(failed)), result='failed')
+
+        # the records are committed once, so the users can be applied in several chunks
+        if self.state:
+            with self.lock:
+                records, self.records = self.records, {}
+            self.state.commit(
+                records=records,
+                disabled=[c.username for c in changes if c.action == DISABLE],
+                failed=failed,
+                applied=set([c.username for c in changes if c.username])
+            )
+
+        # the users skipped after the deadline passed are failed, their changes stay journaled
+        self.deadline.check()
+        return failed
+
+    def _create_user(self, change):
+        """
+        create a single user
+        :param change: create change of the user
+        :return: the username if the creation failed, otherwise None
+        """
+
+        if self.deadline.expired():
+            return change.username
+        try:
+            LinuxUser(username=change.username, accountdb=self.accountdb).create(
+                groups=change.value['groups'], shell=change.value['shell'])
+        except Exception as e:
+            logging.warning(f'Unable to manage user {change.username}: {e}')
+            return change.username
+
+        return None
+
+    def _rewrite_keys(self, username, ssh_keys):
+        """
+        write the authorized keys file of a single user
+        :param username:
+        :param ssh_keys: list of ssh keys
+        :return: the username if the file couldnt be written, otherwise None
+        """
+
+        if self.deadline.expired():
+            return username
+        linux_user = LinuxUser(username=username, accountdb=self.accountdb)
+        linux_user.ssh_keys = list(ssh_keys)
+        try:
+            linux_user.authorized_keys(index=self.authorized_keys_index)
+        except Exception as e:
+            logging.warning(f'Unable to manage user {username}: {e}')
+            return username
+
+        return None
@@ -0,0 +1,202 @@
+import hashlib
+import logging
+import random
+import select
+import signal
+import socket
+import time
+import os
+
+
+class TransientError(Exception):
+    """
+        raised for failures which are expected to resolve on their own, the cycle is retried
+    """
+    pass
+
+
+class CycleTimeout(TransientError):
+    """
+        raised if a sync cycle exceeds its deadline
+    """
+    pass
+
+
+def is_transient(error):
+    """
+    returns true if the error of a failed cycle is transient, e.g. a timeout or a failed http request.
+    other errors, e.g. configuration or programming errors, arent retried
+    :param error: exception raised by the cycle
+    :return:
+    """
+
+    if isinstance(error, (TransientError, ConnectionError, TimeoutError)):
+        return True
+
+    # the http clients are only imported if a cycle failed
+    import requests
+    if isinstance(error, requests.exceptions.RequestException):
+        return True
+    try:
+        from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+    except ImportError:
+        return False
+    return isinstance(error, (HttpResponseError, ServiceRequestError, ServiceResponseError))
+
+
+class Deadline(object):
+    """
+        cooperative deadline of a sync cycle. the sync checks it between its phases and tasks,
+        pending tasks are cancelled while running ones complete. hung requests are ended by
+        their http timeouts
+    """
+
+    def __init__(self):
+        self.timeout = None
+        self.expires_at = None
+
+    def start(self, timeout):
+        """
+        start the deadline
+        :param timeout: seconds from now, none or 0 disables the deadline
+        :return:
+        """
+
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout if timeout else None
+
+    def expired(self):
+        """
+        returns true if the deadline passed
+        :return:
+        """
+
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def check(self):
+        """
+        raise CycleTimeout if the deadline passed
+        :return:
+        """
+
+        if self.expired():
+            raise CycleTimeout(f'Sync cycle exceeded its deadline of {self.timeout}s')
+
+
+class Scheduler(object):
+    """
+        execute the sync cycles. the cycles of different hosts are spread with a per host
+        offset and random jitter, cycles failed with transient errors are retried with an exponential
+        backoff and a resync can be triggered at any time by sending SIGUSR1
+    """
+
+    def __init__(self, interval, jitter=0.1, timeout=None, backoff=10, trigger_signal=signal.SIGUSR1, deadline=None):
+        """
+        initialize the scheduler
+        :param interval: seconds between two sync cycles
+        :param jitter: fraction of the interval used to spread the cycles of different hosts
+        :param timeout: optional deadline of a single cycle in seconds
+        :param backoff: seconds to wait after the first failed cycle, doubled for every further failure
+        :param trigger_signal: signal triggering an immediate resync
+        :param deadline: Deadline checked by the cycle, started with the timeout for every cycle
+        """
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = timeout
+        self.deadline = deadline or Deadline()
+        self.backoff = backoff
+        self.failures = 0
+
+        # the signal handler only writes to a non blocking pipe, wait selects its read end
+        self.trigger_read, self.trigger_write = os.pipe()
+        os.set_blocking(self.trigger_read, False)
+        os.set_blocking(self.trigger_write, False)
+        signal.signal(trigger_signal, self._trigger)
+
+    def get_host_offset(self):
+        """
+        returns a stable per host offset within the jitter window, so hosts started at
+        the same time dont query azure at the same time
+        :return: seconds
+        """
+
+        digest = hashlib.sha256(socket.getfqdn().encode()).digest()
+        return int.from_bytes(digest[:4], 'big') / 2 ** 32 * self.interval * self.jitter
+
+    def get_delay(self):
+        """
+        returns the seconds to wait before the next cycle
+        :return: seconds
+        """
+
+        if self.failures:
+            # exponential backoff, capped at the regular interval
+            delay = min(self.interval, self.backoff * 2 ** (self.failures - 1))
+            return delay * random.uniform(0.5, 1)
+
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def run(self, cycle):
+        """
+        execute the given cycle function until the process is stopped
+        :param cycle: function executing a single sync cycle
+        :return:
+        """
+
+        offset = self.get_host_offset()
+        logging.debug(f'Wait {offset:.1f}s before the first sync')
+        self.wait(offset)
+
+        while True:
+            self.run_once(cycle)
+            self.wait(self.get_delay())
+
+    def run_once(self, cycle):
+        """
+        execute the given cycle function once within the deadline. transient errors are logged
+        and retried with the backoff, all other errors are raised
+        :param cycle: function executing a single sync cycle
+        :return: true if the cycle succeeded
+        """
+
+        start = time.monotonic()
+        self.deadline.start(self.timeout)
+
+        try:
+            cycle()
+            self.failures = 0
+            return True
+        except Exception as e:
+            if not is_transient(e):
+                raise e
+            self.failures += 1
+            logging.error(f'Sync failed ({self.failures} consecutive failures): {e}')
+            return False
+        finally:
+            self.deadline.start(None)
+            logging.debug(f'Sync cycle finished after {time.monotonic() - start:.1f}s')
+
+    def wait(self, seconds):
+        """
+        wait the given number of seconds, or until a resync is triggered
+        :param seconds:
+        :return:
+        """
+
+        # interrupted selects are resumed with the remaining timeout
+        readable, _, _ = select.select([self.trigger_read], [], [], max(0, seconds))
+        if readable:
+            try:
+                while os.read(self.trigger_read, 64):
+                    pass
+            except BlockingIOError:
+                pass
+            logging.info('Resync triggered')
+
+    def _trigger(self, signum, frame):
+        # a signal handler mustnt take locks, the main thread may hold them
+        try:
+            os.write(self.trigger_write, b'\0')
+        except BlockingIOError:
+            # the pipe is full, a resync is triggered already
+            pass
@@ -0,0 +1,289 @@
+from metrics import registry
+from users import LinuxUser
+from util import atomic_write
+from .scheduler import TransientError
+import logging
+import hashlib
+import hmac
+import json
+import gzip
+import time
+import os
+
+# snapshot format identifier, followed by the signature and the compressed payload
+SNAPSHOT_MAGIC = b'AADSNAP1'
+# version of the payload layout, bump if the layout changes
+SNAPSHOT_VERSION = 1
+
+
+def encode_snapshot(linux_users, key):
+    """
+    encode the given linux users as a versioned, compressed and signed snapshot
+    :param linux_users: list of LinuxUser with the ssh keys retrieved from azure
+    :param key: secret used to sign the snapshot (hmac-sha256)
+    :return: bytes
+    """
+
+    payload = {
+        'version': SNAPSHOT_VERSION,
+        'serial': int(time.time()),
+        'users': [
+            {
+                'username': u.username,
+                'userPrincipalName': u.user_principal_name,
+                'id': u.object_id,
+                'ssh_keys': u.ssh_keys,
+                'manage_ssh_keys': u.manage_ssh_keys,
+            }
+            for u in linux_users
+        ],
+    }
+
+    data = gzip.compress(json.dumps(payload, sort_keys=True).encode())
+    signature = hmac.new(key.encode(), data, hashlib.sha256).hexdigest().encode()
+    return SNAPSHOT_MAGIC + b'\n' + signature + b'\n' + data
+
+
+def decode_snapshot(snapshot, key):
+    """
+    verify and decode a snapshot created by encode_snapshot
+    :param snapshot: bytes
+    :param key: secret used to sign the snapshot (hmac-sha256)
+    :return: payload dictionary
+    """
+
+    try:
+        magic, signature, data = snapshot.split(b'\n', 2)
+    except ValueError:
+        raise ValueError('Invalid snapshot format')
+
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError('Invalid snapshot format')
+    if not hmac.compare_digest(signature, hmac.new(key.encode(), data, hashlib.sha256).hexdigest().encode()):
+        raise ValueError('Invalid snapshot signature')
+
+    payload = json.loads(gzip.decompress(data).decode())
+    if payload.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f'Unsupported snapshot version {payload.get("version")}')
+
+    return payload
+
+
+def _is_url(location):
+    return location.startswith('http://') or location.startswith('https://')
+
+
+def _default_session():
+    # requests is only imported for http locations, file snapshots dont require it
+    import requests
+    return requests.Session()
+
+
+class SnapshotPublisher(object):
+    """
+        publish snapshots of the users retrieved from azure to a file or a http location,
+        so many hosts can sync from a single fetch
+    """
+
+    def __init__(self, location, key, session=None, timeout=(10, 60)):
+        """
+        initialize the publisher
+        :param location: file path or http(s) url the snapshot is written (PUT) to
+        :param key: secret used to sign the snapshot
+        :param session: requests session used for http locations
+        :param timeout: (connect, read) timeout of http requests in seconds
+        """
+        self.location = location
+        self.key = key
+        self.session = session or (_default_session() if _is_url(location) else None)
+        self.timeout = timeout
+
+    def publish(self, linux_users):
+        """
+        publish a snapshot of the given linux users
+        :param linux_users: list of LinuxUser with the ssh keys retrieved from azure
+        :return:
+        """
+
+        snapshot = encode_snapshot(linux_users=linux_users, key=self.key)
+        logging.info(f'Publish snapshot of {len(linux_users)} users to {self.location}')
+
+        if _is_url(self.location):
+            r = self.session.put(url=self.location, data=snapshot, timeout=self.timeout)
+            r.raise_for_status()
+            return
+
+        # atomically replace the snapshot, readers never see a partial file
+        atomic_write(self.location, snapshot, mode=0o0644)
+
+
+class SnapshotSource(object):
+    """
+        read snapshots published by a SnapshotPublisher instead of querying azure.
+        unchanged snapshots are neither transferred nor decoded again
+    """
+
+    def __init__(self, location, key, cache_file=None, session=None, timeout=(10, 60), max_age=0):
+        """
+        initialize the snapshot source
+        :param location: file path or http(s) url to read the snapshot from
+        :param key: secret used to verify the snapshot signature
+        :param cache_file: optional file to keep the last snapshot, its etag and serial in between restarts
+        :param session: requests session used for http locations
+        :param timeout: (connect, read) timeout of http requests in seconds
+        :param max_age: reject snapshots published more than the given seconds ago, 0 disables the check
+        """
+        self.location = location
+        self.key = key
+        self.cache_file = cache_file
+        self.session = session or (_default_session() if _is_url(location) else None)
+        self.timeout = timeout
+        self.max_age = max_age
+        self.snapshot = None
+        self.validators = {}
+        self.payload = None
+        # serial of the newest accepted snapshot, older snapshots are rejected
+        self.serial = None
+        self.load()
+
+    def get_users(self):
+        """
+        returns the linux users of the current snapshot
+        :return: list of LinuxUser with their ssh keys
+        """
+
+        validators = self.validators
+        if _is_url(self.location):
+            snapshot = self._get_http()
+        else:
+            snapshot = self._get_file()
+
+        if snapshot is not None:
+            try:
+                payload = decode_snapshot(snapshot=snapshot, key=self.key)
+                self._check_serial(payload)
+            except Exception as e:
+                # the rejected snapshot is retrieved and reported again by the next sync
+                self.validators = validators
+                raise e
+            self.payload = payload
+            self.serial = payload['serial']
+            logging.info(f'Loaded snapshot {self.serial} with {len(self.payload["users"])} users')
+            self.snapshot = snapshot
+            self.save()
+        elif self.payload is None:
+            self.payload = decode_snapshot(snapshot=self.snapshot, key=self.key)
+        self._check_age(self.payload)
+
+        linux_users = []
+        for u in self.payload['users']:
+            lu = LinuxUser(username=u['username'])
+            lu.user_principal_name = u.get('userPrincipalName')
+            lu.object_id = u.get('id')
+            lu.ssh_keys = list(u.get('ssh_keys', []))
+            lu.manage_ssh_keys = u.get('manage_ssh_keys', True)
+            linux_users.append(lu)
+
+        return linux_users
+
+    def _check_serial(self, payload):
+        """
+        reject snapshots older than the last accepted one, a replayed snapshot would restore revoked ssh keys
+        :param payload: decoded snapshot
+        :return:
+        """
+
+        serial = payload.get('serial')
+        if not isinstance(serial, int):
+            raise ValueError('Invalid snapshot serial')
+        if self.serial is not None and serial < self.serial:
+            raise TransientError(f'Snapshot {serial} is older than the last accepted snapshot {self.serial}')
+
+    def _check_age(self, payload):
+        """
+        reject outdated snapshots, e.g. if the producer stopped publishing or the location is frozen
+        :param payload: decoded snapshot
+        :return:
+        """
+
+        age = time.time() - payload.get('serial', 0)
+        if self.max_age and age > self.max_age:
+            raise TransientError(f'Snapshot {payload.get("serial")} was published {int(age)}s ago, '
+                             f'the maximum age is {self.max_age}s')
+
+    def _get_http(self):
+        """
+        conditionally retrieve the snapshot from the http location
+        :return: bytes or None if the snapshot didnt change
+        """
+
+        headers = {}
+        if self.snapshot is not None:
+            if self.validators.get('etag'):
+                headers['If-None-Match'] = self.validators['etag']
+            if self.validators.get('last_modified'):
+                headers['If-Modified-Since'] = self.validators['last_modified']
+
+        r = self.session.get(url=self.location, headers=headers, timeout=self.timeout)
+        if r.status_code == 304:
+            logging.debug(f'Snapshot {self.location} not modified')
+            return None
+        r.raise_for_status()
+        registry.inc('http_response_bytes_total', len(r.content), client='snapshot')
+
+        self.validators = {
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+        }
+        return r.content
+
+    def _get_file(self):
+        """
+        read the snapshot file if it changed since it was last read
+        :return: bytes or None if the snapshot didnt change
+        """
+
+        stat = os.stat(self.location)
+        signature = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+        if self.snapshot is not None and self.validators.get('signature') == signature:
+            logging.debug(f'Snapshot {self.location} not modified')
+            return None
+
+        with open(self.location, 'rb') as file:
+            snapshot = file.read()
+        self.validators = {'signature': signature}
+        return snapshot
+
+    def load(self):
+        """
+        load the cached snapshot and its validators
+        :return:
+        """
+
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return
+
+        try:
+            with open(self.cache_file, 'rb') as file:
+                self.snapshot = file.read()
+            with open(f'{self.cache_file}.json') as file:
+                self.validators = json.load(file)
+            # the serial is kept besides the validators, so replays are rejected after a restart
+            self.serial = self.validators.pop('serial', None)
+        except Exception as e:
+            logging.warning(f'Unable to load cached snapshot {self.cache_file}: {e}')
+            self.snapshot = None
+            self.validators = {}
+
+    def save(self):
+        """
+        persist the current snapshot and its validators
+        :return:
+        """
+
+        if not self.cache_file:
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), mode=0o0700, exist_ok=True)
+        atomic_write(self.cache_file, self.snapshot)
+        atomic_write(f'{self.cache_file}.json', json.dumps(dict(self.validators, serial=self.serial)))
@@ -0,0 +1,205 @@
+import threading
+import logging
+import sqlite3
+import json
+import time
+import os
+
+
+class StateStore(object):
+    """
+        persisted state of the users applied to the local system. the changes of a cycle are
+        journaled before they are applied and only cleared once they succeeded, so users of a
+        partially applied cycle are fully reconciled again after a crash or restart
+    """
+
+    def __init__(self, path):
+        """
+        initialize the state store
+        :param path: path to the sqlite database
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.users = {}
+        self.pending = set()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), mode=0o0700, exist_ok=True)
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS users ('
+                    'username TEXT PRIMARY KEY, upn TEXT, object_id TEXT, keys_hash TEXT, groups TEXT, shell TEXT, '
+                    'applied_at INTEGER, disabled_at INTEGER)'
+                )
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS journal ('
+                    'id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL, action TEXT NOT NULL, '
+                    'value TEXT, created_at INTEGER NOT NULL)'
+                )
+        finally:
+            connection.close()
+        os.chmod(self.path, 0o0600)
+        self.load()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def load(self):
+        """
+        load the applied users and the usernames with pending changes
+        :return:
+        """
+
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                'SELECT username, upn, object_id, keys_hash, groups, shell, disabled_at FROM users'
+            ).fetchall()
+            pending = connection.execute('SELECT DISTINCT username FROM journal').fetchall()
+        finally:
+            connection.close()
+
+        with self.lock:
+            self.users = {
+                r[0]: {'upn': r[1], 'object_id': r[2], 'keys_hash': r[3],
+                       'groups': json.loads(r[4]) if r[4] else [], 'shell': r[5], 'disabled_at': r[6]}
+                for r in rows
+            }
+            self.pending = set([r[0] for r in pending])
+
+        if self.pending:
+            logging.info(f'Resume {len(self.pending)} users with pending changes of an interrupted sync')
+
+    def is_current(self, username, record):
+        """
+        returns true if the given state was applied to the user and no changes of the user are pending
+        :param username: linux username
+        :param record: dictionary with the upn, object_id, keys_hash, groups and shell of the user
+        :return:
+        """
+
+        with self.lock:
+            return username not in self.pending and self._recorded(username, record)
+
+    def _recorded(self, username, record):
+        # the user is recorded with the given state and not disabled, the caller holds the lock
+        applied = self.users.get(username)
+        if not applied or applied.get('disabled_at'):
+            return False
+        return all([applied.get(k) == v for k, v in record.items()])
+
+    def begin(self, changes):
+        """
+        journal the changes before they are applied
+        :param changes: list of changes
+        :return:
+        """
+
+        now = int(time.time())
+        usernames = set([c.username for c in changes if c.username])
+        if not usernames:
+            return
+        connection = self._connect()
+        try:
+            with connection:
+                # the changes of a user journaled by a previous sync are replaced, users failing
+                # every sync dont grow the journal
+                connection.executemany('DELETE FROM journal WHERE username = ?', [(u,) for u in usernames])
+                connection.executemany(
+                    'INSERT INTO journal (username, action, value, created_at) VALUES (?, ?, ?, ?)',
+                    [(c.username, c.action, json.dumps(c.value), now) for c in changes if c.username]
+                )
+        finally:
+            connection.close()
+
+        with self.lock:
+            self.pending.update(usernames)
+
+    def prune(self, usernames):
+        """
+        remove the journaled changes of all users except the given ones
+        :param usernames: set of usernames whose journaled changes are kept
+        :return: number of removed users
+        """
+
+        with self.lock:
+            removed = [u for u in self.pending if u not in usernames]
+        if not removed:
+            return 0
+
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executemany('DELETE FROM journal WHERE username = ?', [(u,) for u in removed])
+        finally:
+            connection.close()
+
+        with self.lock:
+            self.pending.difference_update(removed)
+        return len(removed)
+
+    def commit(self, records, disabled, failed, applied=[]):
+        """
+        record the applied state and clear the journal of the applied users without failed changes.
+        the journal of users applied by other chunks or left by an interrupted sync is kept
+        :param records: dictionary of usernames and their applied state
+        :param disabled: usernames of the disabled users
+        :param failed: usernames with failed changes
+        :param applied: usernames with changes in this apply
+        :return:
+        """
+
+        now = int(time.time())
+        failed = set(failed)
+        records = {u: r for u, r in records.items() if u not in failed}
+        disabled = [u for u in disabled if u not in failed]
+        # planned users without changes are current as well, their journal of an earlier sync is cleared
+        cleared = (set(applied) | set(records) | set(disabled)) - failed
+        with self.lock:
+            cleared = cleared & self.pending
+            # the records of users already recorded with the same state arent written again
+            records = {u: r for u, r in records.items() if not self._recorded(u, r)}
+            # a cycle without changes doesnt write the state store
+            if not records and not disabled and not cleared:
+                return
+
+        connection = self._connect()
+        try:
+            with connection:
+                for username, r in records.items():
+                    connection.execute(
+                        'INSERT OR REPLACE INTO users '
+                        '(username, upn, object_id, keys_hash, groups, shell, applied_at, disabled_at) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, NULL)',
+                        (username, r.get('upn'), r.get('object_id'), r.get('keys_hash'),
+                         json.dumps(r.get('groups')), r.get('shell'), now)
+                    )
+                for username in disabled:
+                    # users disabled without ever being recorded are added, so the disable date is known
+                    connection.execute('INSERT OR IGNORE INTO users (username) VALUES (?)', (username,))
+                    connection.execute(
+                        'UPDATE users SET applied_at = ?, disabled_at = ? WHERE username = ?', (now, now, username)
+                    )
+                connection.executemany('DELETE FROM journal WHERE username = ?', [(u,) for u in cleared])
+        finally:
+            connection.close()
+
+        self.load()
+
+    def disabled_users(self):
+        """
+        returns the users disabled by the sync, most recently disabled first
+        :return: list of dictionaries with the username, upn, object_id and disabled_at
+        """
+
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                'SELECT username, upn, object_id, disabled_at FROM users '
+                'WHERE disabled_at IS NOT NULL ORDER BY disabled_at DESC, username'
+            ).fetchall()
+        finally:
+            connection.close()
+
+        return [{'username': r[0], 'upn': r[1], 'object_id': r[2], 'disabled_at': r[3]} for r in rows]
@@ -1,3 +1,5 @@
-from .aduser import AdUser, sort_ad_users_unique
+from .accountdatabase import AccountDatabase, accountdb
+from .aduser import AdUser, index_ssh_keys, sort_ad_users_unique, ssh_key_owners
+from .authorizedkeysindex import AuthorizedKeysIndex
 from .linuxgroup import LinuxGroup
 from .linuxuser import LinuxUser
\ No newline at end of file
@@ -0,0 +1,217 @@
+import threading
+import logging
+import grp
+import pwd
+
+
+class AccountDatabase(object):
+    """
+        in-process snapshot of the passwd and group databases. the snapshot is loaded
+        once and served from memory until it is invalidated after a modification
+    """
+
+    def __init__(self, passwd_file=None, group_file=None):
+        """
+        initialize the account database. by default the entries are loaded with
+        the pwd and grp modules (nss), if files are given they are parsed instead
+        :param passwd_file: optional passwd file, e.g. /etc/passwd
+        :param group_file: optional group file, e.g. /etc/group
+        """
+        self.passwd_file = passwd_file
+        self.group_file = group_file
+        self.lock = threading.RLock()
+        self.passwd_entries = None
+        self.group_entries = None
+        self.group_memberships = None
+        self.group_names = None
+
+    def refresh(self):
+        """
+        (re)load the passwd and group entries
+        :return:
+        """
+
+        with self.lock:
+            logging.debug('Load passwd and group databases')
+            if self.passwd_file:
+                passwd_entries = self._parse(self.passwd_file)
+            else:
+                passwd_entries = [
+                    [p.pw_name, p.pw_passwd, str(p.pw_uid), str(p.pw_gid), p.pw_gecos, p.pw_dir, p.pw_shell]
+                    for p in pwd.getpwall()
+                ]
+
+            if self.group_file:
+                group_entries = self._parse(self.group_file)
+            else:
+                group_entries = [
+                    [g.gr_name, g.gr_passwd, str(g.gr_gid), ','.join(g.gr_mem)]
+                    for g in grp.getgrall()
+                ]
+
+            # the first entry wins, same as getent
+            self.passwd_entries = {}
+            for p in passwd_entries:
+                self.passwd_entries.setdefault(p[0], p)
+            self.group_entries = {}
+            self.group_names = {}
+            for g in group_entries:
+                self.group_entries.setdefault(g[0], g)
+                self.group_names.setdefault(g[2], g[0])
+
+            # map users to their supplementary groups
+            self.group_memberships = {}
+            for g in self.group_entries.values():
+                for m in g[3].split(','):
+                    if m:
+                        self.group_memberships.setdefault(m, []).append(g[0])
+
+    def invalidate(self):
+        """
+        drop the snapshot, it is reloaded with the next lookup
+        :return:
+        """
+
+        with self.lock:
+            self.passwd_entries = None
+            self.group_entries = None
+            self.group_memberships = None
+            self.group_names = None
+
+    def add_user(self, username, groups=[]):
+        """
+        add a created user to the snapshot instead of reloading the whole databases. the passwd entry
+        and the primary group of the user are looked up, the given supplementary groups are updated in place
+        :param username:
+        :param groups: names of the supplementary groups the user was created with
+        :return:
+        """
+
+        with self.lock:
+            # not loaded yet, the user is part of the next load
+            if self.passwd_entries is None:
+                return
+
+            entry = self._lookup_passwd(username)
+            if not entry:
+                self.invalidate()
+                return
+            self.passwd_entries.setdefault(username, entry)
+
+            # the primary group is usually created together with the user
+            if entry[3] not in self.group_names:
+                g = self._lookup_group(gid=entry[3])
+                if not g:
+                    self.invalidate()
+                    return
+                self.group_entries.setdefault(g[0], g)
+                self.group_names.setdefault(g[2], g[0])
+
+            memberships = self.group_memberships.setdefault(username, [])
+            for name in groups:
+                g = self.group_entries.get(name)
+                if not g:
+                    self.invalidate()
+                    return
+                if name in memberships:
+                    continue
+                self.group_entries[name] = g[:3] + [f'{g[3]},{username}' if g[3] else username]
+                memberships.append(name)
+
+    def _lookup_passwd(self, username):
+        # single passwd entry, the passwd file is searched without parsing all entries
+        if not self.passwd_file:
+            try:
+                p = pwd.getpwnam(username)
+            except KeyError:
+                return None
+            return [p.pw_name, p.pw_passwd, str(p.pw_uid), str(p.pw_gid), p.pw_gecos, p.pw_dir, p.pw_shell]
+
+        with open(self.passwd_file) as file:
+            content = '\n' + file.read()
+        start = content.find(f'\n{username}:')
+        if start < 0:
+            return None
+        end = content.find('\n', start + 1)
+        return content[start + 1:end if end >= 0 else len(content)].split(':')
+
+    def _lookup_group(self, gid):
+        # single group entry by id
+        if not self.group_file:
+            try:
+                g = grp.getgrgid(int(gid))
+            except KeyError:
+                return None
+            return [g.gr_name, g.gr_passwd, str(g.gr_gid), ','.join(g.gr_mem)]
+
+        for g in self._parse(self.group_file):
+            if g[2] == gid:
+                return g
+        return None
+
+    def passwd(self, username):
+        """
+        returns the split passwd entry of the user, same as getent passwd
+        :param username:
+        :return: list 'login:x:uid:gid:gecos:homedir:loginshell' or None
+        """
+
+        with self.lock:
+            if self.passwd_entries is None:
+                self.refresh()
+            return self.passwd_entries.get(username)
+
+    def group(self, name):
+        """
+        returns the split group entry of the group, same as getent group
+        :param name:
+        :return: list 'group:x:id:members' or None
+        """
+
+        with self.lock:
+            if self.group_entries is None:
+                self.refresh()
+            return self.group_entries.get(name)
+
+    def get_groups(self, username):
+        """
+        returns the names of all groups the user is member of, same as id -Gn
+        :param username:
+        :return: list of group names
+        """
+
+        with self.lock:
+            p = self.passwd(username)
+            if not p:
+                return []
+
+            groups = []
+            # primary group of the user
+            if p[3] in self.group_names:
+                groups.append(self.group_names[p[3]])
+
+            for g in self.group_memberships.get(username, []):
+                if g not in groups:
+                    groups.append(g)
+
+            return groups
+
+    @staticmethod
+    def _parse(path):
+        """
+        parse a colon separated database file
+        :param path:
+        :return: list of split entries
+        """
+
+        entries = []
+        with open(path) as file:
+            for line in file:
+                line = line.rstrip('\n')
+                if line and not line.startswith('#'):
+                    entries.append(line.split(':'))
+        return entries
+
+
+# account database shared by all user and group objects
+accountdb = AccountDatabase()
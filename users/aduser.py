@@ -1,61 +1,137 @@
 import logging
+import sys
 import re
 
 def sort_ad_users_unique(users, sort_key='mail', unique_key='id'):
     """
-    sort given list of user objects and returns a sorted and unique list of objects
+    sort given list of user objects and returns a sorted and unique list of objects.
+    the source groups of duplicate entries are merged
     :param users: list of user objects
     :return: sorted, unique list
     """
 
-    # loop over the given users list and drop non unique
-    # entries
-    users_unique = []
+    # drop non unique entries, the insertion order of the
+    # dictionary keeps the first occurrence of each user
+    users_unique = {}
     for u in users:
-        is_duplicate = False
-        for uu in users_unique:
-            if getattr(u, unique_key) == getattr(uu, unique_key):
-                is_duplicate = True
+        key = getattr(u, unique_key)
+        if key not in users_unique:
+            users_unique[key] = u
+            continue
+
+        # remember all groups the user was retrieved from
+        uu = users_unique[key]
+        source_groups = getattr(uu, 'source_groups', [])
+        for g in getattr(u, 'source_groups', []):
+            if g not in source_groups:
+                source_groups.append(g)
+        uu.source_groups = source_groups
+
+    # return sorted list of user objects, users without a sort value
+    # (e.g. guest and service accounts without mail) are sorted last
+    def sort_value(a):
+        value = getattr(a, sort_key, None)
+        return value is None, value or ''
+
+    return sorted(users_unique.values(), key=sort_value)
+
+
+# optional identifier of a ssh key file, e.g. the 'secondkey' in seh@foryouandyourcustomers.com.secondkey.pub
+SSH_KEY_IDENTIFIER = re.compile(r'[a-zA-Z0-9-._]*.')
+
+
+def ssh_key_owners(name, ssh_keys_prefix, ssh_keys_suffix):
+    """
+    returns the user principal names a ssh key blob could belong to. the blob names follow the format
+    [prefix][userPrincipalName][.identifier][suffix], as user principal names contain dots themselves
+    the name can be split after any dot in the domain part
+    :param name: blob name
+    :param ssh_keys_prefix: prefix for ssh key files in the storage account
+    :param ssh_keys_suffix: suffix for ssh key files in the storage account
+    :return: list of user principal names, the longest (the name without identifier) first
+    """
+
+    if ssh_keys_prefix and name.startswith(ssh_keys_prefix):
+        name = name[len(ssh_keys_prefix):]
+    if not name.endswith(ssh_keys_suffix):
+        return []
+    name = name[:len(name) - len(ssh_keys_suffix)]
+
+    # the name itself, or the name without the identifier after any dot in the domain part
+    upns = [name]
+    domain = name.find('@')
+    for i in range(len(name) - 1, domain, -1):
+        if name[i] == '.' and SSH_KEY_IDENTIFIER.fullmatch(name[i + 1:]):
+            upns.append(name[:i])
+
+    return [u for u in upns if u]
+
+
+def index_ssh_keys(blobs, ssh_keys_prefix, ssh_keys_suffix, user_principal_names):
+    """
+    index the given ssh key blobs by user principal name. each blob belongs to a single user, the
+    user whose user principal name matches the blob name exactly, otherwise the longest user principal
+    name of the given users the blob name starts with. e.g. bob@contoso.com.au.pub belongs to
+    bob@contoso.com.au if that user exists, and only otherwise to bob@contoso.com
+    :param blobs: list of blobs as returned by AzureContainer.get_blobs
+    :param ssh_keys_prefix: prefix for ssh key files in the storage account
+    :param ssh_keys_suffix: suffix for ssh key files in the storage account
+    :param user_principal_names: set of the user principal names of all synced users
+    :return: dictionary of user principal names and their ssh key blobs
+    """
+
+    index = {}
+    for b in blobs:
+        for upn in ssh_key_owners(b.get('name', ''), ssh_keys_prefix=ssh_keys_prefix, ssh_keys_suffix=ssh_keys_suffix):
+            if upn in user_principal_names:
+                index.setdefault(upn, []).append(b)
                 break
 
-        if not is_duplicate:
-            users_unique.append(u)
+    return index
+
 
-    # return sorted list of user objects
-    return sorted(users_unique, key=lambda a: getattr(a, sort_key))
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
 
 
 class AdUser(object):
     """
         represent a user account - data is a mix of user information retrieved
-        from azure ad and the local linux system
+        from azure ad and the local linux system. only the fields used by the sync
+        are kept, groups with 100k members are held by the daemon at once
     """
 
-    def __init__(self, **kwargs):
+    # fields of the azure user kept by the sync, all other retrieved fields are dropped
+    FIELDS = ('id', 'userPrincipalName', 'mail')
+
+    __slots__ = FIELDS + ('source_groups', 'username_field', 'username_value')
+
+    def __init__(self, source_groups=[], username_field=None, **kwargs):
         """
             initialize user object. the constructor is called
             from the dictionary returned by the member list retrieved
             by the azuread client
+        :param source_groups: ids of the groups the user was retrieved from
+        :param username_field: field containing the value for the linux username, kept besides the FIELDS
         """
 
-        # load all retrieved values from azure graph as attributes
-        for k,v in kwargs.items():
-            setattr(self, k, v)
+        for k in self.FIELDS:
+            setattr(self, k, kwargs.get(k))
+        # the group ids are shared by all members, keep a single copy of each
+        self.source_groups = [_intern(g) for g in source_groups]
+        self.username_field = _intern(username_field)
+        self.username_value = kwargs.get(username_field) if username_field else None
 
-    def get_valid_ssh_keys(self, ssh_keys_prefix, ssh_keys_suffix):
+    def get_ssh_keys(self, ssh_keys_index):
         """
-        :param ssh_keys_prefix: prefix for ssh key files in the storage account
-        :param ssh_keys_suffix: suffix for ssh key files in the storage account
-        :return:
+        :param ssh_keys_index: ssh key blobs indexed by user principal name, see index_ssh_keys
+        :return: list of the users ssh key blobs
         """
 
-        if not getattr(self, 'userPrincipalName'):
+        if not self.userPrincipalName:
             raise ValueError('No userPrinicipalName set. unable to create ssh key name for user')
 
-        regexp = f'{getattr(self, "userPrincipalName")}(\.[a-zA-Z0-9-._]*?.)?{ssh_keys_suffix}'
-        if ssh_keys_prefix:
-            regexp = f'({ssh_keys_prefix})?{regexp}'
-        return re.compile(regexp)
+        return ssh_keys_index.get(self.userPrincipalName, [])
 
     def get_linux_username(self, username_field):
         """
@@ -64,7 +140,10 @@ class AdUser(object):
         :return: string with valid linux username
         """
 
-        username_value = getattr(self, username_field, None)
+        if username_field == self.username_field:
+            username_value = self.username_value
+        else:
+            username_value = getattr(self, username_field, None) if username_field in self.FIELDS else None
         if not username_value:
             raise ValueError(f'Unable to get value for linux username from field {username_field}')
 
@@ -0,0 +1,101 @@
+from util import atomic_write, keys_hash
+import threading
+import logging
+import json
+import os
+
+
+class AuthorizedKeysIndex(object):
+    """
+        persisted index of the managed ssh keys last written to each users authorized keys file.
+        as long as the file wasnt modified since (same inode, size and modification time) and
+        the managed keys didnt change, the file doesnt need to be read at all
+    """
+
+    def __init__(self, index_file):
+        """
+        initialize the index
+        :param index_file: file to persist the index in
+        """
+        self.index_file = index_file
+        self.lock = threading.Lock()
+        self.entries = self.load()
+        # only a changed index is saved
+        self.dirty = False
+
+    @staticmethod
+    def file_signature(path):
+        """
+        returns the inode, size and modification time of the file
+        :param path:
+        :return: list or None if the file doesnt exist
+        """
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+    def is_current(self, username, path, ssh_keys):
+        """
+        returns true if the authorized keys file of the user is unchanged since it was
+        indexed and contains the given managed ssh keys
+        :param username:
+        :param path: path to the authorized keys file
+        :param ssh_keys: list of managed ssh keys
+        :return:
+        """
+
+        entry = self.entries.get(username)
+        if not entry or entry.get('path') != path or entry.get('keys') != keys_hash(ssh_keys):
+            return False
+        return entry.get('signature') == self.file_signature(path)
+
+    def update(self, username, path, ssh_keys):
+        """
+        index the current state of the authorized keys file of the user
+        :param username:
+        :param path: path to the authorized keys file
+        :param ssh_keys: list of managed ssh keys written to the file
+        :return:
+        """
+
+        entry = {
+            'path': path,
+            'keys': keys_hash(ssh_keys),
+            'signature': self.file_signature(path),
+        }
+        with self.lock:
+            if self.entries.get(username) != entry:
+                self.entries[username] = entry
+                self.dirty = True
+
+    def load(self):
+        """
+        load the persisted index
+        :return: dictionary of usernames and index entries
+        """
+
+        if not os.path.isfile(self.index_file):
+            return {}
+
+        try:
+            with open(self.index_file) as file:
+                return json.load(file)
+        except Exception as e:
+            logging.warning(f'Unable to load authorized keys index {self.index_file}: {e}')
+            return {}
+
+    def save(self):
+        """
+        atomically persist the index, if it changed since it was loaded or saved
+        :return:
+        """
+
+        with self.lock:
+            if not self.dirty:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_file)), mode=0o0700, exist_ok=True)
+            atomic_write(self.index_file, json.dumps(self.entries))
+            self.dirty = False
@@ -1,4 +1,5 @@
 from cli import Cli
+from .accountdatabase import accountdb as default_accountdb
 import logging
 
 class LinuxGroup(object):
@@ -6,12 +7,14 @@ class LinuxGroup(object):
         represent a local linux user group
     """
 
-    def __init__(self, name):
+    def __init__(self, name, accountdb=None):
         """
         initialize the group object
         :param name:
+        :param accountdb: account database snapshot used for lookups
         """
         self.name = name
+        self.accountdb = accountdb or default_accountdb
 
 
     def exists(self):
@@ -20,7 +23,7 @@ class LinuxGroup(object):
         :return:
         """
 
-        if Cli.getent(database='group', key=self.name):
+        if self.getent():
             return True
         else:
             return False
@@ -34,6 +37,7 @@ class LinuxGroup(object):
         if not self.exists():
             logging.info(f'Create linux group {self.name}')
             Cli.groupadd(name=self.name)
+            self.accountdb.invalidate()
 
 
     def getent(self):
@@ -43,11 +47,8 @@ class LinuxGroup(object):
         :return: getent list
         """
 
-        group_entry = Cli.getent(database='group', key=self.name)
-        if group_entry:
-            # split group entry 'group:x:id:members'
-            return group_entry.decode().strip().split(':')
-        return None
+        # split group entry 'group:x:id:members'
+        return self.accountdb.group(self.name)
 
     def get_id(self):
         """
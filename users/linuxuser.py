@@ -1,18 +1,73 @@
 from cli import Cli
+from metrics import registry
+from .accountdatabase import accountdb as default_accountdb
+import hashlib
+import secrets
 import logging
+import stat
 import os
 
+
+def _hash(content):
+    # hash of the authorized keys file content
+    return hashlib.sha256(content.encode()).digest()
+
+
+def _open_directory(path):
+    # open the directory without following symlinks, the folders in the home directories are
+    # controlled by the users and could point anywhere. all file operations are relative to it
+    try:
+        return os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        raise ValueError(f'Unable to open {path}, symbolic links arent followed: {e}')
+
+
+def _read_regular_file(path):
+    # read the file without following symlinks, returns None if the file doesnt exist
+    dir_fd = _open_directory(os.path.dirname(path))
+    if dir_fd is None:
+        return None
+    try:
+        fd = os.open(os.path.basename(path), os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK, dir_fd=dir_fd)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        raise ValueError(f'Unable to read {path}, symbolic links arent followed: {e}')
+    finally:
+        os.close(dir_fd)
+
+    with os.fdopen(fd) as file:
+        if not stat.S_ISREG(os.fstat(file.fileno()).st_mode):
+            raise ValueError(f'Unable to read {path}: not a regular file')
+        return file.read()
+
+
+def _unchanged(current_content, content):
+    # a missing authorized keys file without any keys to write is left missing
+    if current_content is None:
+        return not content
+    return _hash(current_content) == _hash(content)
+
+
 class LinuxUser(object):
     """
     represent a local linux user
     """
 
-    def __init__(self, username):
+    __slots__ = ('username', 'accountdb', 'user_principal_name', 'object_id', 'ssh_keys', 'manage_ssh_keys')
+
+    def __init__(self, username, accountdb=None):
         """
         initialize the linux user object
         :param username:
+        :param accountdb: account database snapshot used for lookups
         """
         self.username = username
+        self.accountdb = accountdb or default_accountdb
+        self.user_principal_name = None
+        self.object_id = None
         self.ssh_keys = []
         self.manage_ssh_keys = True
 
@@ -22,20 +77,24 @@ class LinuxUser(object):
         :return:
         """
 
-        if Cli.getent(database='passwd', key=self.username):
+        if self.getent():
             return True
         else:
             return False
 
-    def create(self):
+    def create(self, groups=[], shell=None):
         """
         create user
+        :param groups: optional groups to join the new user to
+        :param shell: optional login shell of the new user
         :return:
         """
 
         if not self.exists():
             logging.info(f'Create linux user {self.username}')
-            Cli.useradd(username=self.username)
+            Cli.useradd(username=self.username, groups=groups, shell=shell)
+            # only the created user is added to the snapshot, creating many users doesnt reload it every time
+            self.accountdb.add_user(self.username, groups=groups)
 
     def getent(self):
         """
@@ -44,11 +103,8 @@ class LinuxUser(object):
         :return: getent list
         """
 
-        passwd_entry = Cli.getent(database='passwd', key=self.username)
-        if passwd_entry:
-            # split passwd entry 'login:x:uid:gid::homedir:loginshell'
-            return passwd_entry.decode().strip().split(':')
-        return None
+        # split passwd entry 'login:x:uid:gid::homedir:loginshell'
+        return self.accountdb.passwd(self.username)
 
     def get_home(self):
         """
@@ -95,116 +151,152 @@ class LinuxUser(object):
             return p[6]
         return None
 
-    def check_managed_user(self, managed_group):
+    def get_groups(self):
         """
-        check if the user already exists and if it exists
-        make sure its in the managed
-        :return:
+        returns the names of all groups the user is member of
+        :return: list of group names
         """
 
-        if not self.exists():
-            return
-
-        if not managed_group in Cli.getgroupmembership(self.username):
-            raise ValueError(f'User {self.username} already exists but not member in {managed_group}')
+        return self.accountdb.get_groups(self.username)
 
-    def authorized_keys(self,
-                        authorized_keys_file='.ssh/authorized_keys',
-                        authorized_keys_comment='managed by azure-ad-user-to-linux'):
+    def get_authorized_keys_path(self, authorized_keys_file='.ssh/authorized_keys'):
         """
-        manage authorized keys file
-        :return:
+        returns the full path to the authorized keys file of the user
+        :param authorized_keys_file: path of the authorized keys file relative to the home directory
+        :return: path
         """
 
-        if not self.manage_ssh_keys:
-            logging.warning(f'Unable to manage ssh keys for user {self.username}')
-            return
-
-        # setup full path to the authorized keys file
-        authorized_keys = os.path.join(self.get_home(), authorized_keys_file)
+        return os.path.join(self.get_home(), authorized_keys_file)
 
-        logging.info(f'Update authorized keys file {authorized_keys}')
-
-        # make sure the auth to the authorized keys file exists
-        os.makedirs(
-            name=os.path.dirname(authorized_keys),
-            mode=0o0755,
-            exist_ok=True
-        )
+    def read_authorized_keys(self,
+                             authorized_keys_file='.ssh/authorized_keys',
+                             authorized_keys_comment='managed by azure-ad-user-to-linux'):
+        """
+        read the authorized keys file and render its new content
+        :return: tuple of the current content (None if the file doesnt exist) and the new content
+        """
 
-        # make sure ownership of the folder are correct
-        os.chown(
-            path=os.path.dirname(authorized_keys),
-            uid=self.get_uid(),
-            gid=self.get_gid(),
-        )
+        # setup full path to the authorized keys file
+        authorized_keys = self.get_authorized_keys_path(authorized_keys_file)
 
         # now get the authorized keys file,
         # if it exists load the ssh keys
+        current_content = _read_regular_file(authorized_keys)
         current_authorized_keys = []
-        if os.path.isfile(authorized_keys):
-            with open(authorized_keys) as file:
-                # load all lines but drop all the previously managed ssh keys - identified by the comment
-                for line in file:
-                    l = line.strip()
-                    if l and not l.endswith(authorized_keys_comment):
-                        current_authorized_keys.append(l)
+        if current_content is not None:
+            registry.inc('authorized_keys_reads_total')
+            # load all lines but drop all the previously managed ssh keys - identified by the comment
+            for line in current_content.splitlines():
+                l = line.strip()
+                if l and not l.endswith(authorized_keys_comment):
+                    current_authorized_keys.append(l)
 
         # (re)add the ssh public keys retrieved from the storage account
         for key in self.ssh_keys:
             current_authorized_keys.append(f'{key} {authorized_keys_comment}')
 
-        # overwrite authorized keys file with new list
-        with open(authorized_keys, 'w') as file:
-            for l in current_authorized_keys:
-                file.write(f'{l}\n')
+        return current_content, ''.join([f'{l}\n' for l in current_authorized_keys])
 
-        # and ensure ownership and permission of the file is correct
-        os.chown(
-            path=authorized_keys,
-            uid=self.get_uid(),
-            gid=self.get_gid(),
-        )
-        os.chmod(
-            path=authorized_keys,
-            mode=0o0644
-        )
-
-    def group_memberships(self, managed_group, additional_groups):
+    def authorized_keys_changed(self, index=None,
+                                authorized_keys_file='.ssh/authorized_keys',
+                                authorized_keys_comment='managed by azure-ad-user-to-linux'):
         """
-        join the user account to additional linux groups
-        the function only adds users to groups, never removes them
-
-        :param additional_groups: list of additional groups the user should be joined to
-        :param managed_group: default managed group all users need to be joined to
+        returns true if the authorized keys file needs to be rewritten
+        :param index: optional AuthorizedKeysIndex, unchanged indexed files arent read
         :return:
         """
 
-        Cli.joingroup(username=self.username, group=managed_group)
-
-        for g in additional_groups:
-            try:
-                logging.info(f'Add user {self.username} to linux group {g}')
-                Cli.joingroup(username=self.username, group=g)
-            except Exception as e:
-                logging.warning(e)
+        authorized_keys = self.get_authorized_keys_path(authorized_keys_file)
+        if index and index.is_current(self.username, authorized_keys, self.ssh_keys):
+            return False
 
+        current_content, content = self.read_authorized_keys(
+            authorized_keys_file=authorized_keys_file,
+            authorized_keys_comment=authorized_keys_comment
+        )
+        if _unchanged(current_content, content):
+            if index:
+                index.update(self.username, authorized_keys, self.ssh_keys)
+            return False
+        return True
 
-    def login_shell(self, login_shell='/bin/bash'):
+    def authorized_keys(self, index=None,
+                        authorized_keys_file='.ssh/authorized_keys',
+                        authorized_keys_comment='managed by azure-ad-user-to-linux'):
         """
-        set login shell of user to /bin/bash if set to /sbin/nologin
-        if set to a different login shell dont touch it
-        :param login_shell:
+        manage authorized keys file. the file is only written if its content changes,
+        the new content is written to a temporary file which is renamed into place
+        :param index: optional AuthorizedKeysIndex, updated after the file is written
         :return:
         """
 
-        current_shell = self.get_login_shell()
+        if not self.manage_ssh_keys:
+            logging.warning(f'Unable to manage ssh keys for user {self.username}')
+            return
+
+        # setup full path to the authorized keys file
+        authorized_keys = self.get_authorized_keys_path(authorized_keys_file)
+
+        current_content, content = self.read_authorized_keys(
+            authorized_keys_file=authorized_keys_file,
+            authorized_keys_comment=authorized_keys_comment
+        )
 
         # nothing to do here
-        if current_shell == login_shell:
-            return None
+        if _unchanged(current_content, content):
+            if index:
+                index.update(self.username, authorized_keys, self.ssh_keys)
+            return
+
+        logging.info(f'Update authorized keys file {authorized_keys}')
+
+        uid = self.get_uid()
+        gid = self.get_gid()
+
+        # make sure the path to the authorized keys file exists
+        # with correct ownership of the folder
+        ssh_dir = os.path.dirname(authorized_keys)
+        created = False
+        if not os.path.lexists(ssh_dir):
+            os.makedirs(
+                name=ssh_dir,
+                mode=0o0755,
+                exist_ok=True
+            )
+            created = True
+
+        # the folder is owned by the user, a symlink could redirect the write to any file
+        dir_fd = _open_directory(ssh_dir)
+        if dir_fd is None:
+            raise ValueError(f'Unable to write {authorized_keys}: {ssh_dir} doesnt exist')
+        if created:
+            os.fchown(dir_fd, uid, gid)
+
+        # write the new content to a temporary file with the correct ownership
+        # and permissions, and atomically replace the authorized keys file with it.
+        # sshd never sees a partially written file. the temporary file is created
+        # exclusively with an unpredictable name, it cant be planted by the user
+        name = os.path.basename(authorized_keys)
+        tmp_name = f'.{name}.{secrets.token_hex(8)}.tmp'
+        try:
+            fd = os.open(tmp_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o0600, dir_fd=dir_fd)
+            try:
+                with os.fdopen(fd, 'w') as file:
+                    file.write(content)
+                    file.flush()
+                    os.fchown(file.fileno(), uid, gid)
+                    os.fchmod(file.fileno(), 0o0644)
+                os.rename(tmp_name, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+                registry.inc('authorized_keys_writes_total')
+            except Exception as e:
+                try:
+                    os.unlink(tmp_name, dir_fd=dir_fd)
+                except FileNotFoundError:
+                    pass
+                raise e
+        finally:
+            os.close(dir_fd)
+
+        if index:
+            index.update(self.username, authorized_keys, self.ssh_keys)
 
-        # only change shell if its set to nologin
-        if current_shell == '/sbin/nologin':
-            logging.info(f'Set users {self.username} login shell to {login_shell}')
-            Cli.setloginshell(username=self.username, shell=login_shell)
@@ -0,0 +1 @@
+from .files import atomic_write, keys_hash
\ No newline at end of file
@@ -0,0 +1,42 @@
+import threading
+import os
+
+# imported by the authorized keys command on every ssh login, keep the imports to a minimum
+
+
+def keys_hash(ssh_keys):
+    """
+    returns a hash of the given ssh keys, shared by the key store, the authorized keys index and the state store
+    :param ssh_keys: list of ssh keys
+    :return: hex digest
+    """
+
+    import hashlib
+    return hashlib.sha256('\n'.join(ssh_keys).encode()).hexdigest()
+
+
+def atomic_write(path, content, mode=0o0600):
+    """
+    atomically replace the file with the given content, readers never see a partial file.
+    the temporary file is unique per process and thread and created with the final permissions
+
+    :param path: path of the file
+    :param content: str or bytes
+    :param mode: permissions of the file
+    :return:
+    """
+
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, mode)
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(content, bytes) else 'w') as file:
+            # the permissions of an existing temporary file or the umask dont apply
+            os.fchmod(file.fileno(), mode)
+            file.write(content)
+        os.rename(tmp_path, path)
+    except Exception as e:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise e